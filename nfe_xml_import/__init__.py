@@ -1,2 +1,4 @@
 # -*- coding: utf-8 -*-
-from . import models
\ No newline at end of file
+from . import cli
+from . import controllers
+from . import models
@@ -21,8 +21,11 @@ Este módulo otimiza a entrada de mercadorias no Odoo através da leitura de arq
     'depends': ['base', 'stock', 'product', 'account'],
     'data': [
         'security/ir.model.access.csv',
+        'data/nfe_config_parameters.xml',
+        'data/nfe_cron.xml',
         'views/nfe_import_views.xml',
         'views/nfe_wizard_views.xml',
+        'views/nfe_import_run_views.xml',
     ],
     'images': [
         'static/description/main_screenshot.png',
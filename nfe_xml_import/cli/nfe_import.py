@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Comando ``odoo-bin nfe_import``: importação em lote, sem interface web, de
+diretórios ou arquivos ZIP com XMLs de NFe e de eventos.
+
+Exemplo::
+
+    odoo-bin nfe_import -c odoo.conf -d producao --company 1 \\
+        --workers 8 --batch-size 200 /arquivos/nfe/2019.zip
+
+O comando cria (ou retoma) um ``nfe.import.run`` para o caminho informado.
+``--workers`` vale apenas para a preparação do lote: a leitura, a
+identificação e a validação XSD dos arquivos rodam nesses processos, o que
+compensa com a validação XSD ativa. A importação em si (análise completa de
+cada XML e gravação no banco) roda no processo principal, na ordem da
+data/hora dos documentos, com um savepoint por arquivo e um commit a cada
+``--batch-size`` arquivos. Se for interrompido, basta rodar o
+mesmo comando de novo: o lote continua do primeiro arquivo pendente.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+from odoo import SUPERUSER_ID, api
+from odoo.cli import Command
+from odoo.tools import config
+
+_logger = logging.getLogger(__name__)
+
+
+class NfeImport(Command):
+    """Importa em lote arquivos XML de NFe de um diretório ou ZIP"""
+    name = 'nfe_import'
+
+    def run(self, cmdargs):
+        parser = argparse.ArgumentParser(
+            prog=f'{Path(sys.argv[0]).name} {self.name}',
+            description=self.__doc__.strip(),
+        )
+        parser.add_argument('-c', '--config', dest='config', help="Arquivo de configuração do Odoo")
+        parser.add_argument('-d', '--database', dest='db_name', required=True, help="Banco de dados")
+        parser.add_argument('--company', required=True, help="Id ou nome da empresa")
+        parser.add_argument('--workers', type=int, default=1,
+                            help="Processos de leitura e validação XSD na preparação do lote (padrão: 1). "
+                                 "A importação em si roda sempre no processo principal")
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Arquivos por commit no banco (padrão: 100)")
+        parser.add_argument('--max-errors', type=int, default=50,
+                            help="Quantidade de erros listados no resumo final (padrão: 50)")
+        parser.add_argument('path', help="Diretório ou arquivo ZIP com os XMLs")
+        args, unknown = parser.parse_known_args(cmdargs)
+
+        if not os.path.exists(args.path):
+            sys.exit("Caminho não encontrado: %s" % args.path)
+        if args.workers < 1 or args.batch_size < 1:
+            sys.exit("--workers e --batch-size devem ser maiores que zero")
+
+        odoo_args = list(unknown)
+        if args.config:
+            odoo_args += ['-c', args.config]
+        config.parse_config(odoo_args + ['-d', args.db_name], setup_logging=True)
+
+        from odoo.modules.registry import Registry
+        registry = Registry(args.db_name)
+        with registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            company = self._find_company(env, args.company)
+            self._import(env, company, args)
+
+    def _find_company(self, env, value):
+        Company = env['res.company']
+        company = Company.browse(int(value)).exists() if value.isdigit() else Company.search([('name', '=', value)], limit=1)
+        if not company:
+            sys.exit("Empresa não encontrada: %s" % value)
+        return company
+
+    def _get_run(self, env, company, path):
+        """Lote ainda não concluído para o caminho e a empresa, ou um novo."""
+        Run = env['nfe.import.run'].with_company(company)
+        run = Run.search([
+            ('source_path', '=', path),
+            ('company_id', '=', company.id),
+            ('state', '!=', 'done'),
+        ], order='id desc', limit=1)
+        if run:
+            print("Retomando o lote %s (%s pendentes)" % (run.id, run.pending_count))
+            return run
+        run = Run.create({
+            'name': "Linha de comando: %s" % os.path.basename(path.rstrip(os.sep)),
+            'company_id': company.id,
+            'source_path': path,
+        })
+        env.cr.commit()
+        return run
+
+    def _import(self, env, company, args):
+        started = time.monotonic()
+        run = self._get_run(env, company, os.path.abspath(args.path))
+
+        def progress(done, total):
+            elapsed = time.monotonic() - started
+            print("%s/%s processados (%.1f arquivos/s)" % (done, total, done / elapsed if elapsed else 0.0))
+
+        if not run._execute(max_workers=args.workers, batch_size=args.batch_size, progress=progress):
+            sys.exit("O lote %s já está sendo processado por outro processo" % run.id)
+
+        run.invalidate_recordset()
+        if run.state == 'error':
+            sys.exit("Falha ao preparar o lote %s: %s" % (run.id, run.message))
+        total_elapsed = time.monotonic() - started
+        print("\nConcluído em %.1fs (%.1f arquivos/s)" % (
+            total_elapsed, run.file_count / total_elapsed if total_elapsed else 0.0))
+        print("  importados: %s\n  com erro: %s" % (run.done_count, run.error_count))
+        if run.error_count:
+            errors = env['nfe.import.run.file'].search_read(
+                [('run_id', '=', run.id), ('state', '=', 'error')], ['filename', 'message'],
+                order='sequence, id', limit=args.max_errors)
+            print("\nErros:")
+            for error in errors:
+                print("  %s: %s" % (error['filename'], (error['message'] or '').replace('\n', ' ')))
+            if run.error_count > args.max_errors:
+                print("  ... e mais %s erros" % (run.error_count - args.max_errors))
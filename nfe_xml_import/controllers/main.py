@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import os
+import re
+import uuid
+
+from odoo import api, http
+from odoo.exceptions import UserError
+from odoo.http import content_disposition, request
+from odoo.tools.translate import _
+
+_logger = logging.getLogger(__name__)
+
+# Tamanho dos blocos copiados da requisição para o disco
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _copy_stream(stream, spool, digest=None):
+    """Copia stream para spool em blocos, atualizando digest. Retorna os bytes copiados."""
+    size = 0
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return size
+        spool.write(chunk)
+        if digest is not None:
+            digest.update(chunk)
+        size += len(chunk)
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as spool:
+        for chunk in iter(lambda: spool.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class NFeXmlImportController(http.Controller):
+
+    @http.route('/nfe_xml_import/export/<int:export_id>', type='http', auth='user', methods=['GET'])
+    def export_xml_zip(self, export_id, **kwargs):
+        """
+        Baixa o ZIP com os XMLs e o CSV de itens de uma exportação em lote.
+        A resposta é gerada sob demanda, em blocos.
+        """
+        export = request.env['nfe.xml.export'].browse(export_id).exists()
+        if not export:
+            raise request.not_found()
+        export.log_ids.check_access('read')
+        filename = export._get_download_filename()
+
+        registry = request.env.registry
+        uid = request.env.uid
+        context = dict(request.env.context)
+
+        def generate():
+            # O cursor da requisição é fechado antes de a resposta ser
+            # consumida, então o gerador usa um cursor próprio.
+            with registry.cursor() as cr:
+                env = api.Environment(cr, uid, context)
+                yield from env['nfe.xml.export'].browse(export_id)._iter_zip_stream()
+
+        return http.Response(
+            generate(),
+            headers=[
+                ('Content-Type', 'application/zip'),
+                ('Content-Disposition', content_disposition(filename)),
+            ],
+            direct_passthrough=True,
+        )
+
+    # Upload de lotes grandes
+    #
+    # Os arquivos são gravados em disco em blocos, sem passar por base64 nem
+    # pelo JSON-RPC, e entregues ao nfe.import.run pelo caminho. A importação
+    # roda depois, no cron de lotes.
+
+    def _upload_path(self, upload_id):
+        """Arquivo parcial de um upload em partes, restrito ao usuário que o iniciou."""
+        if not UPLOAD_ID_RE.match(upload_id or ''):
+            raise request.not_found()
+        upload_dir = request.env['nfe.import.run']._get_upload_dir()
+        return os.path.join(upload_dir, '%s-%s.part' % (request.env.uid, upload_id))
+
+    def _create_upload_run(self, path, sha256, filename):
+        """Entrega o arquivo recebido (.part) ao lote de importação e agenda a execução."""
+        final_path = path[:-len('.part')]
+        os.replace(path, final_path)
+        size = os.path.getsize(final_path)
+
+        # Sem o lote (transação desfeita), o arquivo não seria mais removido
+        def remove_upload():
+            if os.path.exists(final_path):
+                os.unlink(final_path)
+        request.env.cr.postrollback.add(remove_upload)
+        try:
+            run = request.env['nfe.import.run']._create_from_path(
+                final_path, sha256, name=filename or os.path.basename(final_path))
+        except Exception:
+            if os.path.exists(final_path):
+                os.unlink(final_path)
+            raise
+        request.env.ref('nfe_xml_import.ir_cron_nfe_import_run_resume')._trigger()
+        return request.make_json_response({
+            'run_id': run.id,
+            'sha256': sha256,
+            'size': size,
+            'duplicate': run.source_path != final_path,
+        })
+
+    @http.route('/nfe_xml_import/upload', type='http', auth='user', methods=['POST'])
+    def upload_xml_batch(self, file=None, filename=None, **kwargs):
+        """
+        Recebe um XML ou ZIP em um único envio, como campo multipart ``file``
+        ou no corpo da requisição (``application/octet-stream``, com o nome
+        em ``filename``), e cria um lote de importação.
+        """
+        request.env['nfe.import.run'].check_access('create')
+        upload_dir = request.env['nfe.import.run']._get_upload_dir()
+        path = os.path.join(upload_dir, '%s-%s.part' % (request.env.uid, uuid.uuid4().hex))
+        stream = file.stream if file else request.httprequest.stream
+        digest = hashlib.sha256()
+        try:
+            with open(path, 'wb') as spool:
+                size = _copy_stream(stream, spool, digest)
+            if not size:
+                raise UserError(_("Nenhum arquivo recebido."))
+            return self._create_upload_run(path, digest.hexdigest(), filename or (file and file.filename))
+        except UserError as e:
+            return request.make_json_response({'error': str(e)}, status=400)
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    @http.route('/nfe_xml_import/upload/chunk', type='http', auth='user', methods=['POST'])
+    def upload_xml_chunk(self, upload_id=None, offset=0, **kwargs):
+        """
+        Recebe uma parte de um upload no corpo da requisição. A primeira
+        parte vai sem ``upload_id`` e a resposta traz o id a usar nas
+        seguintes. ``offset`` deve ser o tamanho já recebido: em caso de
+        divergência (parte repetida ou perdida) a resposta 409 informa o
+        tamanho atual, a partir do qual o cliente retoma o envio.
+        """
+        request.env['nfe.import.run'].check_access('create')
+        upload_id = upload_id or uuid.uuid4().hex
+        path = self._upload_path(upload_id)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if not str(offset).isdigit() or int(offset) != size:
+            return request.make_json_response({'upload_id': upload_id, 'size': size}, status=409)
+        with open(path, 'ab') as spool:
+            size += _copy_stream(request.httprequest.stream, spool)
+        return request.make_json_response({'upload_id': upload_id, 'size': size})
+
+    @http.route('/nfe_xml_import/upload/<string:upload_id>/finish', type='http', auth='user', methods=['POST'])
+    def upload_xml_finish(self, upload_id, filename=None, sha256=None, **kwargs):
+        """
+        Conclui um upload em partes e cria o lote de importação. Se o
+        cliente informar ``sha256``, o arquivo recebido é conferido.
+        """
+        request.env['nfe.import.run'].check_access('create')
+        path = self._upload_path(upload_id)
+        if not os.path.exists(path):
+            raise request.not_found()
+        received = _file_sha256(path)
+        if sha256 and sha256.lower() != received:
+            os.unlink(path)
+            return request.make_json_response(
+                {'error': _("SHA-256 divergente: arquivo recebido com %s") % received}, status=400)
+        try:
+            return self._create_upload_run(path, received, filename)
+        except UserError as e:
+            return request.make_json_response({'error': str(e)}, status=400)
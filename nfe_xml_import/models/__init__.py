@@ -1,4 +1,12 @@
 # -*- coding: utf-8 -*-
+from . import res_partner
+from . import nfe_import_context
+from . import nfe_stock_lock
 from . import nfe_xml_import
+from . import nfe_imported_line
+from . import nfe_event
+from . import nfe_uom_mapping
+from . import nfe_import_run
+from . import nfe_xml_export
 from . import nfe_sefaz_query_wizard
 from . import nfe_certificate_config
\ No newline at end of file
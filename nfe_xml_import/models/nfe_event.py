@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import base64
+import logging
+from datetime import datetime, timezone
+
+from lxml import etree
+from odoo import api, fields, models
+from odoo.exceptions import UserError
+from odoo.tools.translate import _
+
+from .nfe_schema import parse_nfe_xml
+
+_logger = logging.getLogger(__name__)
+
+EVENT_CANCELAMENTO = '110111'
+EVENT_CARTA_CORRECAO = '110110'
+
+# cStat de evento registrado e vinculado à NF-e (ou registrado fora do prazo)
+EVENT_REGISTERED_STATUS = ('135', '136', '155')
+
+EVENT_ROOT_TAGS = ('procEventoNFe', 'evento')
+
+
+class NFeImportedEvent(models.Model):
+    _name = 'nfe.imported.event'
+    _description = 'Log de Eventos de NFe Importados'
+    _rec_name = 'nfe_chave'
+    _order = 'data_evento desc, id desc'
+
+    nfe_chave = fields.Char('Chave de Acesso', required=True, index=True)
+    log_id = fields.Many2one('nfe.imported.log', 'NFe', index=True, ondelete='set null')
+    tipo_evento = fields.Selection([
+        (EVENT_CANCELAMENTO, 'Cancelamento'),
+        (EVENT_CARTA_CORRECAO, 'Carta de Correção'),
+        ('outro', 'Outro'),
+    ], string='Tipo de Evento', required=True)
+    codigo_evento = fields.Char('Código do Evento (tpEvento)')
+    sequencia = fields.Integer('Sequência (nSeqEvento)', default=1)
+    data_evento = fields.Datetime('Data do Evento')
+    protocolo = fields.Char('Protocolo')
+    descricao = fields.Text('Justificativa / Correção')
+    estoque_revertido = fields.Boolean('Estoque Revertido', readonly=True)
+    data_importacao = fields.Datetime('Data de Importação', default=fields.Datetime.now)
+    usuario_importacao = fields.Many2one('res.users', 'Usuário', default=lambda self: self.env.user)
+    xml_filename = fields.Char('Nome do Arquivo XML')
+    xml_file = fields.Binary('Arquivo XML', attachment=True, readonly=True)
+    company_id = fields.Many2one('res.company', string='Empresa', required=True, default=lambda self: self.env.company)
+
+    _sql_constraints = [
+        ('evento_unico', 'unique(nfe_chave, codigo_evento, sequencia)', 'Este evento já foi importado anteriormente!'),
+    ]
+
+    @api.model
+    def _parse_event_xml(self, xml_content):
+        """
+        Extrai os dados de um XML de evento (procEventoNFe ou evento).
+        """
+        try:
+            root = parse_nfe_xml(xml_content)
+        except etree.XMLSyntaxError as e:
+            raise UserError(_("Erro ao analisar XML do evento: %s") % str(e))
+
+        ns = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
+        inf_evento = root.find('.//nfe:evento/nfe:infEvento', ns)
+        if inf_evento is None:
+            inf_evento = root.find('nfe:infEvento', ns)
+        if inf_evento is None:
+            raise UserError(_("XML inválido: não foi possível encontrar informações do evento"))
+
+        ret_evento = root.find('.//nfe:retEvento/nfe:infEvento', ns)
+        if ret_evento is not None:
+            status = ret_evento.findtext('nfe:cStat', default='', namespaces=ns)
+            if status not in EVENT_REGISTERED_STATUS:
+                raise UserError(_("Evento não registrado pela SEFAZ (cStat %s): %s") % (
+                    status, ret_evento.findtext('nfe:xMotivo', default='', namespaces=ns)))
+
+        codigo = inf_evento.findtext('nfe:tpEvento', default='', namespaces=ns)
+        det_evento = inf_evento.find('nfe:detEvento', ns)
+        descricao = ''
+        protocolo = ''
+        if det_evento is not None:
+            descricao = (det_evento.findtext('nfe:xJust', default='', namespaces=ns)
+                         or det_evento.findtext('nfe:xCorrecao', default='', namespaces=ns))
+            protocolo = det_evento.findtext('nfe:nProt', default='', namespaces=ns)
+        if ret_evento is not None:
+            protocolo = ret_evento.findtext('nfe:nProt', default='', namespaces=ns) or protocolo
+
+        data_evento = False
+        dh_evento = inf_evento.findtext('nfe:dhEvento', default='', namespaces=ns)
+        if dh_evento:
+            try:
+                data_evento = datetime.fromisoformat(dh_evento.replace('Z', '+00:00'))
+                if data_evento.tzinfo:
+                    data_evento = data_evento.astimezone(timezone.utc).replace(tzinfo=None)
+            except ValueError:
+                pass
+
+        try:
+            sequencia = int(inf_evento.findtext('nfe:nSeqEvento', default='1', namespaces=ns) or 1)
+        except ValueError:
+            sequencia = 1
+
+        return {
+            'nfe_chave': inf_evento.findtext('nfe:chNFe', default='', namespaces=ns).strip(),
+            'codigo_evento': codigo,
+            'tipo_evento': codigo if codigo in (EVENT_CANCELAMENTO, EVENT_CARTA_CORRECAO) else 'outro',
+            'sequencia': sequencia,
+            'data_evento': data_evento,
+            'protocolo': protocolo,
+            'descricao': descricao,
+        }
+
+    @api.model
+    def _process_event_files(self, files):
+        """
+        Registra um lote de eventos [(nome do arquivo, conteúdo)] e reverte o
+        estoque das NFes canceladas.
+
+        As NFes são localizadas pela chave de acesso (indexada) em uma única
+        consulta, e as quantidades de todas as NFes canceladas do lote são
+        estornadas com um único UPDATE.
+
+        Retorna um dicionário com os eventos criados e as mensagens.
+        """
+        messages = []
+        events_vals = []
+        seen = set()
+        for filename, xml_content in files:
+            vals = self._parse_event_xml(xml_content)
+            if not vals['nfe_chave']:
+                messages.append({'type': 'warning', 'message': _("Evento sem chave de acesso ignorado: %s") % filename})
+                continue
+            key = (vals['nfe_chave'], vals['codigo_evento'], vals['sequencia'])
+            if key in seen:
+                continue
+            seen.add(key)
+            vals.update({
+                'xml_filename': filename or '',
+                'xml_file': base64.b64encode(xml_content),
+            })
+            events_vals.append(vals)
+
+        if not events_vals:
+            return {'events': self.browse(), 'messages': messages}
+
+        chaves = list({vals['nfe_chave'] for vals in events_vals})
+        existing = self.search_read([('nfe_chave', 'in', chaves)], ['nfe_chave', 'codigo_evento', 'sequencia'])
+        existing_keys = {(e['nfe_chave'], e['codigo_evento'], e['sequencia']) for e in existing}
+        new_vals = []
+        for vals in events_vals:
+            if (vals['nfe_chave'], vals['codigo_evento'], vals['sequencia']) in existing_keys:
+                messages.append({'type': 'warning', 'message': _("Evento já importado: %s (%s)") % (
+                    vals['nfe_chave'], vals['codigo_evento'])})
+            else:
+                new_vals.append(vals)
+
+        logs = self.env['nfe.imported.log'].search([('nfe_chave', 'in', chaves)])
+        logs_by_chave = {log.nfe_chave: log for log in logs}
+
+        to_cancel = self.env['nfe.imported.log']
+        cancel_vals = []
+        for vals in new_vals:
+            log = logs_by_chave.get(vals['nfe_chave'])
+            vals['log_id'] = log.id if log else False
+            if not log:
+                # O cancelamento é aplicado quando a NFe for importada
+                messages.append({'type': 'warning', 'message': _(
+                    "NFe do evento ainda não importada: %s") % vals['nfe_chave']})
+            elif vals['tipo_evento'] == EVENT_CANCELAMENTO and log.situacao != 'cancelada' and log not in to_cancel:
+                to_cancel |= log
+                cancel_vals.append((vals, log))
+
+        if to_cancel:
+            reversed_logs = to_cancel._reverse_stock()
+            now = fields.Datetime.now()
+            for vals, log in cancel_vals:
+                # Mesma data usada quando a NFe chega depois do evento (_apply_pending_events)
+                log.write({'situacao': 'cancelada', 'data_cancelamento': vals.get('data_evento') or now})
+                vals['estoque_revertido'] = log in reversed_logs
+            for log in to_cancel:
+                if log in reversed_logs:
+                    messages.append({'type': 'success', 'message': _(
+                        "NFe %s cancelada e estoque revertido") % log.nfe_numero})
+                else:
+                    _logger.warning("NFe %s cancelada sem quantidades lançadas registradas; estoque não revertido",
+                                    log.nfe_chave)
+                    messages.append({'type': 'warning', 'message': _(
+                        "NFe %s cancelada, mas sem estoque lançado registrado: reverta o estoque manualmente") % log.nfe_numero})
+
+        events = self.create(new_vals)
+        _logger.info("Eventos de NFe importados: %s (%s cancelamentos)", len(events), len(to_cancel))
+        return {'events': events, 'messages': messages}
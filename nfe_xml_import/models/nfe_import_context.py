@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from odoo import api, models
+
+
+class NFeImportContext:
+    """
+    Padrões estáticos usados por todas as etapas da importação (categoria,
+    localização, tipo de produto, empresa e unidade de medida), resolvidos
+    uma vez por lote e empresa.
+
+    Os ids vêm de nfe.xml.import._get_import_defaults, que fica em cache no
+    processo e é invalidado quando armazéns, localizações ou categorias mudam.
+    """
+
+    __slots__ = ('company', 'category', 'location', 'product_type_field', 'product_type', 'uom')
+
+    def __init__(self, env, company):
+        defaults = env['nfe.xml.import']._get_import_defaults(company.id)
+        category_id, location_id, self.product_type_field, self.product_type, uom_id = defaults
+        self.company = company
+        self.category = env['product.category'].browse(category_id)
+        self.location = env['stock.location'].browse(location_id)
+        self.uom = env['uom.uom'].browse(uom_id)
+
+    def product_vals(self):
+        """Valores padrão para produtos criados a partir da NFe."""
+        vals = {'categ_id': self.category.id}
+        if self.product_type_field:
+            vals[self.product_type_field] = self.product_type
+        if self.uom:
+            vals.update({'uom_id': self.uom.id, 'uom_po_id': self.uom.id})
+        return vals
+
+
+class StockWarehouse(models.Model):
+    _inherit = 'stock.warehouse'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        # Uma empresa sem armazém usa a localização padrão, que é de outra empresa
+        self.env.registry.clear_cache()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        if {'lot_stock_id', 'company_id', 'active'} & set(vals):
+            self.env.registry.clear_cache()
+        return super().write(vals)
+
+    def unlink(self):
+        self.env.registry.clear_cache()
+        return super().unlink()
+
+
+class StockLocation(models.Model):
+    _inherit = 'stock.location'
+
+    def write(self, vals):
+        if {'active', 'usage', 'company_id'} & set(vals):
+            self.env.registry.clear_cache()
+        return super().write(vals)
+
+    def unlink(self):
+        self.env.registry.clear_cache()
+        return super().unlink()
+
+
+class ProductCategory(models.Model):
+    _inherit = 'product.category'
+
+    def unlink(self):
+        self.env.registry.clear_cache()
+        return super().unlink()
+
+
+class UomUom(models.Model):
+    _inherit = 'uom.uom'
+
+    def write(self, vals):
+        if {'active', 'category_id'} & set(vals):
+            self.env.registry.clear_cache()
+        return super().write(vals)
+
+    def unlink(self):
+        self.env.registry.clear_cache()
+        return super().unlink()
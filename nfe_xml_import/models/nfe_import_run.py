@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+import base64
+import glob
+import hashlib
+import logging
+import os
+import time
+import uuid
+import zipfile
+
+from psycopg2 import OperationalError
+from odoo import api, fields, models
+from odoo.exceptions import UserError
+from odoo.tools import config
+from odoo.tools.translate import _
+
+from .nfe_event import EVENT_ROOT_TAGS
+from .nfe_schema import ROOT_SCHEMAS
+from .nfe_source import close_xml_source, read_xml_source, scan_xml_sources
+from .nfe_stock_lock import CONCURRENCY_ERRORS_TO_RETRY, retry_on_concurrency_error
+
+_logger = logging.getLogger(__name__)
+
+# Namespace dos advisory locks de sessão que impedem duas execuções do mesmo lote
+RUN_LOCK_NAMESPACE = 0x4E4645
+
+# Arquivos importados por commit quando o lote roda pelo cron ou pela interface
+DEFAULT_BATCH_SIZE = 20
+
+# Uploads em partes não concluídos após este tempo são descartados
+UPLOAD_PART_MAX_AGE = 24 * 60 * 60
+
+
+class NFeImportRun(models.Model):
+    _name = 'nfe.import.run'
+    _description = 'Lote de Importação NFe'
+    _order = 'id desc'
+
+    name = fields.Char('Descrição', required=True, default=lambda self: _("Lote de %s") % fields.Datetime.now())
+    company_id = fields.Many2one('res.company', string='Empresa', required=True, default=lambda self: self.env.company)
+    user_id = fields.Many2one('res.users', 'Usuário', default=lambda self: self.env.user)
+    state = fields.Selection([
+        ('pending', 'Pendente'),
+        ('running', 'Em Execução'),
+        ('done', 'Concluído'),
+        ('error', 'Falhou'),
+    ], string='Status', default='pending', required=True, index=True)
+    message = fields.Text('Mensagem', readonly=True)
+    file_ids = fields.One2many('nfe.import.run.file', 'run_id', string='Arquivos')
+    file_count = fields.Integer('Arquivos', compute='_compute_counts')
+    done_count = fields.Integer('Importados', compute='_compute_counts')
+    error_count = fields.Integer('Com Erro', compute='_compute_counts')
+    pending_count = fields.Integer('Pendentes', compute='_compute_counts')
+    date_start = fields.Datetime('Início', readonly=True)
+    date_end = fields.Datetime('Fim', readonly=True)
+    source_path = fields.Char('Arquivo de Origem', readonly=True,
+                              help="XML, ZIP ou diretório de origem, lido direto do disco durante a importação")
+    source_sha256 = fields.Char('SHA-256 da Origem', readonly=True, index=True)
+
+    @api.depends('file_ids.state')
+    def _compute_counts(self):
+        counts = {
+            (run.id, state): count
+            for run, state, count in self.env['nfe.import.run.file']._read_group(
+                [('run_id', 'in', self.ids)], ['run_id', 'state'], ['__count'])
+        }
+        for run in self:
+            run.done_count = counts.get((run.id, 'done'), 0)
+            run.error_count = counts.get((run.id, 'error'), 0)
+            run.pending_count = counts.get((run.id, 'pending'), 0)
+            run.file_count = run.done_count + run.error_count + run.pending_count
+
+    @api.model
+    def _get_upload_dir(self):
+        """Diretório dos uploads recebidos pelo controller, dentro do data_dir do Odoo."""
+        path = os.path.join(config['data_dir'], 'nfe_uploads', self.env.cr.dbname)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @api.model
+    def _create_from_path(self, path, sha256, **vals):
+        """
+        Cria um lote a partir de um XML ou ZIP já gravado em disco. Os
+        arquivos do lote são listados só na execução, fora da requisição web.
+        Um arquivo com o mesmo hash de um lote existente da empresa não gera
+        novo lote: o existente é retornado e o arquivo recebido, removido.
+        """
+        company_id = vals.get('company_id') or self.env.company.id
+        existing = self.search([('source_sha256', '=', sha256), ('company_id', '=', company_id)], limit=1)
+        if existing:
+            os.unlink(path)
+            return existing
+        return self.create(dict(vals, company_id=company_id, source_path=path, source_sha256=sha256))
+
+    @api.model
+    def _create_from_content(self, content, filename):
+        """
+        Grava um ZIP recebido pelo assistente no diretório de uploads e cria
+        o lote a partir dele. O arquivo é removido se a transação for
+        desfeita.
+        """
+        path = os.path.join(self._get_upload_dir(), '%s-%s' % (self.env.uid, uuid.uuid4().hex))
+        with open(path, 'wb') as upload:
+            upload.write(content)
+
+        def remove_upload():
+            if os.path.exists(path):
+                os.unlink(path)
+        self.env.cr.postrollback.add(remove_upload)
+        return self._create_from_path(path, hashlib.sha256(content).hexdigest(), name=filename or os.path.basename(path))
+
+    def _prepare_source_files(self, max_workers=1):
+        """
+        Cria os arquivos do lote a partir de source_path, na ordem da data/hora
+        dos documentos. Cada XML é lido uma vez, identificado e, com a
+        validação XSD ativa, validado; o conteúdo continua no disco e só é
+        lido de novo na importação. Arquivos inválidos ou não reconhecidos
+        entram no lote já com erro.
+
+        max_workers > 1 distribui a leitura entre processos (ver
+        nfe_source.scan_xml_sources).
+        """
+        self.ensure_one()
+        if not os.path.exists(self.source_path):
+            _logger.warning("Arquivo de origem do lote de importação NFe %s não encontrado: %s",
+                            self.id, self.source_path)
+            return
+        schema_dir = self.env['nfe.xml.import']._get_xsd_schema_dir()
+        documents = []
+        rejected = []
+        for name, root_tag, timestamp, errors in scan_xml_sources(self.source_path, schema_dir, max_workers):
+            if not errors and root_tag not in ROOT_SCHEMAS and root_tag not in EVENT_ROOT_TAGS:
+                errors = [_("Documento não reconhecido: %s") % root_tag]
+            if errors:
+                rejected.append((name or '', '\n'.join(errors)))
+            else:
+                documents.append((timestamp, name or '', bool(schema_dir) and root_tag in ROOT_SCHEMAS))
+        documents.sort()
+        if not documents and not rejected:
+            _logger.warning("Nenhum XML no arquivo de origem do lote de importação NFe %s", self.id)
+
+        now = fields.Datetime.now()
+        self.env['nfe.import.run.file'].create([{
+            'run_id': self.id,
+            'sequence': sequence,
+            'filename': os.path.basename(name) or self.name,
+            'source_entry': name or False,
+            'xsd_validated': xsd_validated,
+        } for sequence, (_timestamp, name, xsd_validated) in enumerate(documents, start=1)] + [{
+            'run_id': self.id,
+            'sequence': len(documents) + sequence,
+            'filename': os.path.basename(name) or self.name,
+            'source_entry': name or False,
+            'state': 'error',
+            'message': message,
+            'processed_at': now,
+        } for sequence, (name, message) in enumerate(rejected, start=1)])
+
+    def unlink(self):
+        # Só os arquivos recebidos por upload pertencem ao lote; os caminhos
+        # informados na linha de comando ficam onde estão.
+        upload_dir = self._get_upload_dir()
+        paths = [path for path in self.mapped('source_path') if path and os.path.dirname(path) == upload_dir]
+        res = super().unlink()
+
+        def remove_sources():
+            for path in paths:
+                close_xml_source(path)
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+        self.env.cr.postcommit.add(remove_sources)
+        return res
+
+    def action_run(self):
+        """Executa (ou retoma) o lote, confirmando cada bloco de arquivos no banco."""
+        for run in self:
+            if not run._execute():
+                raise UserError(_("O lote %s já está sendo processado.") % run.name)
+        return True
+
+    def action_retry_errors(self):
+        self.file_ids.filtered(lambda f: f.state == 'error').write({'state': 'pending', 'message': False})
+        self.filtered(lambda r: r.state in ('done', 'error')).write({'state': 'pending', 'message': False})
+        return True
+
+    @api.model
+    def _cron_resume_runs(self):
+        """
+        Retoma lotes pendentes ou interrompidos (queda, timeout, deploy). A
+        falha de um lote é registrada no log e não impede os seguintes.
+        """
+        for run in self.search([('state', 'in', ('pending', 'running'))], order='id'):
+            try:
+                run._execute()
+            except Exception:
+                _logger.exception("Falha ao executar o lote de importação NFe %s", run.id)
+
+    @api.model
+    def _cron_purge_uploads(self):
+        """Remove os arquivos parciais de uploads em partes abandonados."""
+        limit = time.time() - UPLOAD_PART_MAX_AGE
+        for path in glob.glob(os.path.join(self._get_upload_dir(), '*.part')):
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.unlink(path)
+                    _logger.info("Upload de NFe abandonado removido: %s", path)
+            except FileNotFoundError:
+                pass
+
+    def _execute(self, commit=True, max_workers=1, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+        """
+        Processa os arquivos pendentes, do primeiro ainda não concluído em
+        diante, em blocos de batch_size. Cada documento roda em um savepoint
+        próprio e, com commit=True, cada bloco é confirmado junto com o
+        status dos seus arquivos, de modo que uma interrupção nunca
+        reprocessa nem duplica o estoque de um arquivo já importado.
+
+        max_workers é repassado a _prepare_source_files na primeira execução.
+        progress, se informado, é chamado após cada bloco com a quantidade de
+        arquivos processados e o total pendente no início.
+
+        Retorna False se o lote já estiver sendo processado por outro worker.
+        """
+        self.ensure_one()
+        cr = self.env.cr
+        source_path = self.source_path
+        if commit:
+            # Lock de sessão: sobrevive aos commits e é liberado se o processo cair
+            cr.execute("SELECT pg_try_advisory_lock(%s, %s)", (RUN_LOCK_NAMESPACE, self.id))
+            if not cr.fetchone()[0]:
+                return False
+        try:
+            self.write({
+                'state': 'running',
+                'message': False,
+                'date_start': self.date_start or fields.Datetime.now(),
+            })
+            if self.source_path and not self.file_ids:
+                try:
+                    with cr.savepoint():
+                        self._prepare_source_files(max_workers)
+                except Exception as e:
+                    # Origem ilegível (ZIP corrompido, arquivo removido): o lote
+                    # falha sem bloquear o cron; "Reprocessar" tenta de novo
+                    _logger.exception("Falha ao preparar o lote de importação NFe %s", self.id)
+                    self.write({'state': 'error', 'message': str(e), 'date_end': fields.Datetime.now()})
+                    if commit:
+                        cr.commit()
+                    return True
+            if commit:
+                cr.commit()
+
+            File = self.env['nfe.import.run.file']
+            import_ctx = self.env['nfe.xml.import']._get_import_context(self.company_id)
+            pending_domain = [('run_id', '=', self.id), ('state', '=', 'pending')]
+            total = File.search_count(pending_domain)
+            processed = 0
+            while True:
+                run_files = File.search(pending_domain, order='sequence, id', limit=batch_size)
+                if not run_files:
+                    break
+                if commit:
+                    retry_on_concurrency_error(cr, run_files._import_batch, import_ctx)
+                    self.env.invalidate_all()
+                else:
+                    run_files._import_batch(import_ctx)
+                processed += len(run_files)
+                if progress:
+                    progress(processed, total)
+
+            self.write({'state': 'done', 'date_end': fields.Datetime.now()})
+            if commit:
+                cr.commit()
+            _logger.info("Lote de importação NFe %s concluído: %s importados, %s com erro",
+                         self.id, self.done_count, self.error_count)
+        except Exception:
+            if commit:
+                # Os arquivos já confirmados ficam; o lote segue 'running' para ser retomado
+                cr.rollback()
+            raise
+        finally:
+            if source_path:
+                close_xml_source(source_path)
+            if commit:
+                cr.execute("SELECT pg_advisory_unlock(%s, %s)", (RUN_LOCK_NAMESPACE, self.id))
+        return True
+
+
+class NFeImportRunFile(models.Model):
+    _name = 'nfe.import.run.file'
+    _description = 'Arquivo de Lote de Importação NFe'
+    _order = 'sequence, id'
+
+    run_id = fields.Many2one('nfe.import.run', 'Lote', required=True, ondelete='cascade', index=True)
+    sequence = fields.Integer('Sequência', default=10)
+    filename = fields.Char('Arquivo')
+    source_entry = fields.Char('Entrada no ZIP', help="Nome do XML dentro do arquivo de origem do lote")
+    xsd_validated = fields.Boolean('Validado (XSD)', readonly=True,
+                                   help="Já validado contra o XSD na preparação do lote")
+    state = fields.Selection([
+        ('pending', 'Pendente'),
+        ('done', 'Importado'),
+        ('error', 'Erro'),
+    ], string='Status', default='pending', required=True, index=True)
+    message = fields.Text('Mensagem')
+    processed_at = fields.Datetime('Processado em', readonly=True)
+    log_id = fields.Many2one('nfe.imported.log', 'NFe', ondelete='set null')
+
+    def _import_batch(self, import_ctx=None):
+        """
+        Importa um bloco de arquivos na transação atual, cada um no seu
+        savepoint. Os fornecedores de todo o bloco são resolvidos antes, de
+        uma só vez; se isso falhar, cada arquivo resolve o seu fornecedor no
+        próprio savepoint, onde o erro fica registrado. Depois de um rollback (conflito de concorrência), o bloco
+        é repetido inteiro, inclusive a resolução dos fornecedores.
+        """
+        run_files = self.filtered(lambda f: f.state == 'pending')
+        contents = {}
+        for run_file in run_files:
+            try:
+                contents[run_file.id] = run_file._read_source()
+            except (OSError, zipfile.BadZipFile, KeyError) as e:
+                run_file._mark_error(str(e))
+        if not contents:
+            return
+
+        Import = self.env['nfe.xml.import'].with_company(run_files.run_id.company_id)
+        try:
+            with self.env.cr.savepoint():
+                partners = Import._resolve_nfe_partners(Import._scan_nfe_emitentes(contents.values()))
+        except OperationalError as e:
+            if e.pgcode in CONCURRENCY_ERRORS_TO_RETRY:
+                raise
+            _logger.warning("Falha ao resolver os fornecedores do bloco no lote %s; "
+                            "cada arquivo resolve o seu: %s", run_files.run_id.id, e)
+            partners = None
+        except Exception as e:
+            # Ex.: CNPJ inválido recusado por check_vat; o erro fica só no arquivo dele
+            _logger.warning("Falha ao resolver os fornecedores do bloco no lote %s; "
+                            "cada arquivo resolve o seu: %s", run_files.run_id.id, e)
+            partners = None
+        for run_file in run_files:
+            if run_file.id in contents:
+                run_file._import(import_ctx, contents[run_file.id], partners)
+
+    def _import(self, import_ctx=None, xml_content=None, partners=None):
+        """
+        Importa este arquivo em um savepoint. Erros do documento são
+        gravados no próprio arquivo; conflitos de concorrência são repassados
+        para que a transação inteira seja repetida.
+        """
+        self.ensure_one()
+        run = self.run_id
+        try:
+            with self.env.cr.savepoint():
+                Import = self.env['nfe.xml.import'].with_company(run.company_id).with_context(
+                    nfe_xsd_prevalidated=self.xsd_validated)
+                record = Import.create({
+                    'xml_file': base64.b64encode(xml_content if xml_content is not None else self._read_source()),
+                    'xml_filename': self.filename,
+                })
+                result = record.process_xml_import(import_ctx, partners)
+        except OperationalError as e:
+            if e.pgcode in CONCURRENCY_ERRORS_TO_RETRY:
+                raise
+            self._mark_error(str(e))
+        except Exception as e:
+            self._mark_error(str(e))
+        else:
+            self.write({
+                'state': 'done',
+                'message': result.get('name'),
+                'processed_at': fields.Datetime.now(),
+                'log_id': result.get('log_id', False),
+            })
+
+    def _read_source(self):
+        """Conteúdo do XML, lido do arquivo de origem do lote."""
+        return read_xml_source(self.run_id.source_path, self.source_entry or None)
+
+    def _mark_error(self, message):
+        _logger.warning("Erro ao importar %s no lote %s: %s", self.filename, self.run_id.id, message)
+        self.write({'state': 'error', 'message': message, 'processed_at': fields.Datetime.now()})
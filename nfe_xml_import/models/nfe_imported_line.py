@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models, tools
+
+
+class NFeImportedLine(models.Model):
+    _name = 'nfe.imported.line'
+    _description = 'Itens de NFes Importadas'
+    _order = 'log_id desc, item, id'
+
+    log_id = fields.Many2one('nfe.imported.log', 'NFe', required=True, index=True, ondelete='cascade')
+    item = fields.Integer('Item (nItem)')
+    codigo_produto = fields.Char('Código do Produto (cProd)')
+    nome_produto = fields.Char('Descrição (xProd)')
+    ncm = fields.Char('NCM', index=True)
+    product_id = fields.Many2one('product.product', 'Produto', ondelete='set null')
+    unidade = fields.Char('Unidade (uCom)')
+    quantidade = fields.Float('Quantidade (qCom)', digits='Product Unit of Measure')
+    valor_unitario = fields.Float('Valor Unitário (vUnCom)', digits='Product Price')
+    valor_total = fields.Float('Valor Total (vProd)')
+    quantidade_estoque = fields.Float('Quantidade em Estoque', digits='Product Unit of Measure',
+                                      help="Quantidade lançada no estoque, já convertida para a unidade do produto")
+
+    # Copiados da NFe para que os relatórios agreguem sem join
+    partner_id = fields.Many2one(related='log_id.partner_id', store=True, string='Fornecedor')
+    data_emissao = fields.Date(related='log_id.data_emissao', store=True, index=True, string='Data de Emissão')
+    situacao = fields.Selection(related='log_id.situacao', store=True, string='Situação')
+    company_id = fields.Many2one(related='log_id.company_id', store=True, index=True, string='Empresa')
+
+    def init(self):
+        # Histórico de preços por produto e volume por fornecedor, por período
+        tools.create_index(self._cr, 'nfe_imported_line_product_date_idx', self._table, ['product_id', 'data_emissao'])
+        tools.create_index(self._cr, 'nfe_imported_line_partner_date_idx', self._table, ['partner_id', 'data_emissao'])
+
+    @api.model
+    def _create_from_nfe(self, nfe_info, produtos_data, product_mapping):
+        """Grava os itens de uma NFe com um único create multi-registro."""
+        return self.create([{
+            'log_id': nfe_info['log_id'],
+            'item': produto.get('item') or index,
+            'codigo_produto': produto.get('codigo_produto') or '',
+            'nome_produto': produto.get('nome_produto') or '',
+            'ncm': produto.get('ncm') or False,
+            'product_id': product_mapping.get(produto['codigo_produto'] or produto['nome_produto'], False),
+            'unidade': produto.get('unidade') or '',
+            'quantidade': produto.get('quantidade_comercial', produto.get('quantidade', 0.0)),
+            'valor_unitario': produto.get('valor_unitario', 0.0),
+            'valor_total': produto.get('valor_total', 0.0),
+            'quantidade_estoque': produto.get('quantidade', 0.0),
+        } for index, produto in enumerate(produtos_data, start=1)])
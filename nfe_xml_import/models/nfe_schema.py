@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Leitura e validação de XMLs de NFe contra os schemas XSD oficiais (pacote de
+liberação do Portal da NF-e).
+
+Os schemas compilados são mantidos em cache por processo e por versão do
+leiaute, de modo que cada ``XMLSchema`` é construído uma única vez.
+"""
+import io
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+
+from lxml import etree
+
+_logger = logging.getLogger(__name__)
+
+NFE_NAMESPACE = 'http://www.portalfiscal.inf.br/nfe'
+
+DEFAULT_SCHEMA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'schemas')
+
+# Arquivo XSD principal de cada tipo de documento raiz
+ROOT_SCHEMAS = {
+    'nfeProc': 'procNFe_v%s.xsd',
+    'NFe': 'nfe_v%s.xsd',
+}
+
+MAX_REPORTED_ERRORS = 10
+
+_SCHEMA_CACHE = {}
+_SCHEMA_LOCK = threading.Lock()
+
+# Parser sem resolução de entidades nem acesso à rede
+XML_PARSER = etree.XMLParser(resolve_entities=False, no_network=True, remove_blank_text=False)
+
+
+class NFeSchemaError(Exception):
+    """Erro de validação de uma NFe, com a lista de erros encontrados."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('\n'.join(errors))
+
+
+def parse_nfe_xml(xml_content):
+    """Analisa o conteúdo (bytes) com o parser seguro e retorna o elemento raiz."""
+    if isinstance(xml_content, str):
+        xml_content = xml_content.encode('utf-8')
+    return etree.fromstring(xml_content, XML_PARSER)
+
+
+def get_root_tag(xml_content):
+    """
+    Identifica o elemento raiz (ex.: nfeProc, NFe, procEventoNFe) lendo apenas
+    o início do documento. Retorna None se o conteúdo não for XML.
+    """
+    try:
+        for _event, element in etree.iterparse(io.BytesIO(xml_content), events=('start',),
+                                               resolve_entities=False, no_network=True):
+            return etree.QName(element).localname
+    except etree.XMLSyntaxError:
+        return None
+    return None
+
+
+def get_document_timestamp(xml_content):
+    """
+    Data/hora de referência do documento: dhEvento para eventos e dhEmi para
+    NFes. Lê o XML apenas até encontrar a tag. Retorna um datetime com fuso.
+    """
+    try:
+        for _event, element in etree.iterparse(io.BytesIO(xml_content), events=('end',),
+                                               resolve_entities=False, no_network=True):
+            if etree.QName(element).localname in ('dhEvento', 'dhEmi') and element.text:
+                value = datetime.fromisoformat(element.text.strip().replace('Z', '+00:00'))
+                if value.tzinfo is None:
+                    value = value.replace(tzinfo=timezone.utc)
+                return value
+    except (etree.XMLSyntaxError, ValueError):
+        pass
+    return datetime.min.replace(tzinfo=timezone.utc)
+
+
+def get_layout_version(root):
+    """Retorna o tipo do documento raiz e a versão do leiaute (atributo versao)."""
+    root_tag = etree.QName(root).localname
+    inf_nfe = root.find('.//{%s}infNFe' % NFE_NAMESPACE)
+    version = inf_nfe.get('versao') if inf_nfe is not None else root.get('versao')
+    return root_tag, version
+
+
+def get_schema(root_tag, version, schema_dir=None):
+    """
+    Retorna o XMLSchema compilado para o documento e versão informados,
+    compilando-o apenas na primeira chamada de cada processo.
+    """
+    schema_dir = schema_dir or DEFAULT_SCHEMA_DIR
+    key = (schema_dir, root_tag, version)
+    schema = _SCHEMA_CACHE.get(key)
+    if schema is not None:
+        return schema
+
+    pattern = ROOT_SCHEMAS.get(root_tag)
+    if not pattern or not version:
+        raise NFeSchemaError(["Documento %s sem leiaute de validação conhecido" % root_tag])
+    path = os.path.join(schema_dir, pattern % version)
+    if not os.path.isfile(path):
+        raise NFeSchemaError(["Schema XSD não encontrado: %s" % path])
+
+    with _SCHEMA_LOCK:
+        schema = _SCHEMA_CACHE.get(key)
+        if schema is None:
+            # Os XSDs da NF-e importam outros arquivos pelo caminho relativo
+            schema = etree.XMLSchema(etree.parse(path))
+            _SCHEMA_CACHE[key] = schema
+            _logger.info("Schema XSD da NFe compilado: %s", path)
+    return schema
+
+
+def validate_nfe_root(root, schema_dir=None):
+    """
+    Valida um documento já analisado. Lança NFeSchemaError com a linha, o
+    caminho XPath e a mensagem de cada erro encontrado.
+    """
+    root_tag, version = get_layout_version(root)
+    schema = get_schema(root_tag, version, schema_dir)
+    with _SCHEMA_LOCK:
+        # O error_log fica no objeto do schema, compartilhado entre threads
+        if schema.validate(root):
+            return
+        log = list(schema.error_log)
+    errors = ["Linha %s, %s: %s" % (entry.line, entry.path, entry.message)
+              for entry in log[:MAX_REPORTED_ERRORS]]
+    if len(log) > MAX_REPORTED_ERRORS:
+        errors.append("... e mais %s erros" % (len(log) - MAX_REPORTED_ERRORS))
+    raise NFeSchemaError(errors)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Leitura dos XMLs de origem de um lote de importação: um diretório, um ZIP
+ou um XML avulso em disco, lidos um documento por vez.
+"""
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from lxml import etree
+
+from .nfe_schema import (
+    NFeSchemaError, ROOT_SCHEMAS, get_document_timestamp, get_root_tag, parse_nfe_xml, validate_nfe_root,
+)
+
+# ZIPs de origem abertos neste processo, reaproveitados entre leituras.
+# Quem lê de um ZIP deve chamar close_xml_source ao terminar.
+_OPEN_ZIPS = {}
+
+
+def iter_xml_sources(path):
+    """
+    Lista, sem lê-los, os XMLs de um diretório (recursivamente) ou de um ZIP.
+    Para um arquivo XML avulso, gera apenas None.
+    """
+    if os.path.isfile(path):
+        if not zipfile.is_zipfile(path):
+            yield None
+            return
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith('.xml'):
+                    yield info.filename
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith('.xml'):
+                yield os.path.relpath(os.path.join(dirpath, filename), path)
+
+
+def read_xml_source(path, name=None):
+    """Lê um XML listado por iter_xml_sources (entrada de ZIP, arquivo de diretório ou avulso)."""
+    if name is None:
+        with open(path, 'rb') as xml_fp:
+            return xml_fp.read()
+    if os.path.isdir(path):
+        with open(os.path.join(path, name), 'rb') as xml_fp:
+            return xml_fp.read()
+    archive = _OPEN_ZIPS.get(path)
+    if archive is None:
+        archive = _OPEN_ZIPS[path] = zipfile.ZipFile(path)
+    return archive.read(name)
+
+
+def close_xml_source(path):
+    """Fecha o ZIP de origem mantido aberto por read_xml_source."""
+    archive = _OPEN_ZIPS.pop(path, None)
+    if archive is not None:
+        archive.close()
+
+
+def _scan_worker(task):
+    """Identifica um XML de origem e, se houver schema_dir, valida as NFes."""
+    path, name, schema_dir = task
+    try:
+        xml_content = read_xml_source(path, name)
+        root_tag = get_root_tag(xml_content)
+        if schema_dir and root_tag in ROOT_SCHEMAS:
+            validate_nfe_root(parse_nfe_xml(xml_content), schema_dir)
+    except etree.XMLSyntaxError as e:
+        return name, None, None, [str(e)]
+    except NFeSchemaError as e:
+        return name, None, None, e.errors
+    except (OSError, zipfile.BadZipFile) as e:
+        return name, None, None, [str(e)]
+    return name, root_tag, get_document_timestamp(xml_content), []
+
+
+def scan_xml_sources(path, schema_dir=False, max_workers=1):
+    """
+    Lê cada XML de path uma vez e gera (nome, tag raiz, data/hora, erros).
+    Com schema_dir, as NFes são também validadas contra o XSD.
+
+    Com max_workers > 1 a leitura roda em processos separados, cada um com
+    o seu cache de schemas; é o caso da linha de comando. Dentro dos workers
+    HTTP e do cron do Odoo a leitura é sempre sequencial.
+    """
+    tasks = ((path, name, schema_dir) for name in iter_xml_sources(path))
+    if max_workers <= 1:
+        yield from map(_scan_worker, tasks)
+        return
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(_scan_worker, tasks, chunksize=64)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import logging
+import random
+import time
+
+from psycopg2 import OperationalError, errorcodes
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+CONCURRENCY_ERRORS_TO_RETRY = (
+    errorcodes.LOCK_NOT_AVAILABLE,
+    errorcodes.SERIALIZATION_FAILURE,
+    errorcodes.DEADLOCK_DETECTED,
+)
+MAX_TRIES_ON_CONCURRENCY_FAILURE = 5
+
+
+def retry_on_concurrency_error(cr, func, *args, **kwargs):
+    """
+    Executa func e confirma a transação, repetindo após um rollback quando o
+    PostgreSQL acusa falha de serialização, deadlock ou lock indisponível.
+
+    Só deve ser usada por quem controla a transação (cron, lotes, linha de
+    comando): em REPEATABLE READ, uma nova tentativa precisa de um novo
+    snapshot. Requisições HTTP já são repetidas pelo próprio Odoo.
+    """
+    for tries in range(1, MAX_TRIES_ON_CONCURRENCY_FAILURE + 1):
+        try:
+            result = func(*args, **kwargs)
+            cr.commit()
+            return result
+        except OperationalError as e:
+            cr.rollback()
+            if e.pgcode not in CONCURRENCY_ERRORS_TO_RETRY or tries == MAX_TRIES_ON_CONCURRENCY_FAILURE:
+                raise
+            wait = random.uniform(0.0, 2 ** tries)
+            _logger.info("Conflito de concorrência (%s) na importação NFe, nova tentativa em %.3fs (%s/%s)",
+                         errorcodes.lookup(e.pgcode), wait, tries, MAX_TRIES_ON_CONCURRENCY_FAILURE)
+            time.sleep(wait)
+
+
+class NFeStockLock(models.Model):
+    """
+    Uma linha por (produto, localização) já movimentada pela importação de
+    NFe. Serve de trava para o lançamento direto em stock_quant: cada
+    transação faz upsert das linhas que vai movimentar, em ordem
+    determinística, antes de ler ou criar o quant.
+
+    Como o upsert disputa a mesma linha, dois importadores do mesmo produto
+    e localização se serializam; e em REPEATABLE READ quem chegar depois
+    recebe falha de serialização em vez de trabalhar sobre um snapshot
+    antigo, evitando quants duplicados e incrementos perdidos.
+    """
+    _name = 'nfe.stock.lock'
+    _description = 'Trava de Estoque da Importação NFe'
+    _log_access = False
+
+    product_id = fields.Many2one('product.product', required=True, ondelete='cascade')
+    location_id = fields.Many2one('stock.location', required=True, ondelete='cascade')
+    locked_at = fields.Datetime()
+
+    _sql_constraints = [
+        ('product_location_uniq', 'unique(product_id, location_id)', 'Trava de estoque duplicada!'),
+    ]
+
+    @api.model
+    def _acquire(self, keys):
+        """
+        Trava os pares (product_id, location_id) informados até o fim da
+        transação, sempre na mesma ordem para não gerar deadlocks.
+        """
+        keys = sorted(set(keys))
+        if not keys:
+            return
+        self.env.cr.execute("""
+            INSERT INTO nfe_stock_lock (product_id, location_id, locked_at)
+            SELECT t.product_id, t.location_id, NOW() AT TIME ZONE 'UTC'
+            FROM unnest(%s::int[], %s::int[]) WITH ORDINALITY AS t(product_id, location_id, seq)
+            ORDER BY t.seq
+            ON CONFLICT (product_id, location_id) DO UPDATE SET locked_at = EXCLUDED.locked_at
+        """, ([k[0] for k in keys], [k[1] for k in keys]))
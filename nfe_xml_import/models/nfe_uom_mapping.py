@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models, tools
+
+from .res_partner import normalize_cnpj
+
+
+class NFeUomMapping(models.Model):
+    _name = 'nfe.uom.mapping'
+    _description = 'Conversão de Unidade do Fornecedor (NFe)'
+    _order = 'unidade, emitente_cnpj'
+
+    unidade = fields.Char('Unidade na NFe', required=True, help="Unidade informada pelo fornecedor (uCom/uTrib), ex.: CX, FD, PCT")
+    emitente_cnpj = fields.Char('CNPJ do Fornecedor', help="Deixe em branco para aplicar a todos os fornecedores")
+    partner_id = fields.Many2one('res.partner', 'Fornecedor', compute='_compute_partner_id')
+    uom_id = fields.Many2one('uom.uom', 'Unidade de Medida', required=True)
+    factor = fields.Float('Fator de Conversão', required=True, default=1.0, digits='Product Unit of Measure',
+                          help="Quantidade na unidade de medida correspondente a 1 unidade da NFe")
+    active = fields.Boolean(default=True)
+
+    _sql_constraints = [
+        ('factor_positivo', 'CHECK(factor > 0)', 'O fator de conversão deve ser positivo!'),
+    ]
+
+    def init(self):
+        # Regras globais têm CNPJ nulo, que o unique() comum não compara
+        if not tools.index_exists(self._cr, 'nfe_uom_mapping_unidade_cnpj_uniq'):
+            tools.create_unique_index(self._cr, 'nfe_uom_mapping_unidade_cnpj_uniq', self._table,
+                                      ['unidade', "COALESCE(emitente_cnpj, '')"])
+
+    @api.depends('emitente_cnpj')
+    def _compute_partner_id(self):
+        partners = self.env['res.partner'].search([
+            ('nfe_vat_digits', 'in', [m.emitente_cnpj for m in self if m.emitente_cnpj]),
+        ])
+        partners_by_cnpj = {p.nfe_vat_digits: p.id for p in partners}
+        for mapping in self:
+            mapping.partner_id = partners_by_cnpj.get(mapping.emitente_cnpj, False)
+
+    @api.model
+    def _normalize_vals(self, vals):
+        if vals.get('unidade'):
+            vals['unidade'] = vals['unidade'].strip().upper()
+        if 'emitente_cnpj' in vals:
+            vals['emitente_cnpj'] = normalize_cnpj(vals['emitente_cnpj']) or False
+        return vals
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create([self._normalize_vals(vals) for vals in vals_list])
+        self.env.registry.clear_cache()
+        return records
+
+    def write(self, vals):
+        res = super().write(self._normalize_vals(vals))
+        self.env.registry.clear_cache()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env.registry.clear_cache()
+        return res
+
+    @api.model
+    @tools.ormcache()
+    def _get_mapping_table(self):
+        """
+        Tabela de conversões ativas {(cnpj ou '', unidade): (uom_id, fator)},
+        carregada uma vez por processo e invalidada quando alguma conversão muda.
+        """
+        self.env.cr.execute("""
+            SELECT unidade, COALESCE(emitente_cnpj, ''), uom_id, factor
+            FROM nfe_uom_mapping
+            WHERE active
+        """)
+        return {(cnpj, unidade): (uom_id, factor) for unidade, cnpj, uom_id, factor in self.env.cr.fetchall()}
+
+    @api.model
+    def _find_mapping(self, unidade, cnpj):
+        """Retorna (uom_id, fator) para a unidade, priorizando a regra do fornecedor."""
+        if not unidade:
+            return None
+        table = self._get_mapping_table()
+        unidade = unidade.strip().upper()
+        return table.get((normalize_cnpj(cnpj), unidade)) or table.get(('', unidade))
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import logging
+import tempfile
+import zipfile
+
+from lxml import etree
+from odoo import fields, models
+
+_logger = logging.getLogger(__name__)
+
+NFE_NS = '{http://www.portalfiscal.inf.br/nfe}'
+
+# Tamanho dos blocos lidos do filestore e do lote de NFes lido por consulta
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_PAGE_SIZE = 500
+
+EXPORT_CSV_HEADERS = [
+    'chave_acesso', 'numero', 'serie', 'emitente_cnpj', 'emitente_nome',
+    'data_emissao', 'valor_total_nfe', 'item', 'codigo_produto', 'nome_produto',
+    'ncm', 'unidade', 'quantidade', 'valor_unitario', 'valor_total_item',
+]
+
+
+class _ZipStreamBuffer(io.RawIOBase):
+    """
+    Destino não posicionável para o zipfile: acumula os bytes escritos até
+    que o gerador os consuma com drain().
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class NFeXmlExport(models.TransientModel):
+    _name = 'nfe.xml.export'
+    _description = 'Exportação em Lote de XMLs NFe'
+
+    log_ids = fields.Many2many('nfe.imported.log', string='NFes')
+
+    def _get_download_filename(self):
+        return 'nfes_%s.zip' % fields.Datetime.now().strftime('%Y%m%d_%H%M%S')
+
+    def _iter_attachment_chunks(self, store_fname, attachment_id):
+        """Lê o conteúdo de um anexo em blocos, sem carregá-lo inteiro na memória."""
+        Attachment = self.env['ir.attachment'].sudo()
+        if store_fname:
+            try:
+                with open(Attachment._full_path(store_fname), 'rb') as xml_fp:
+                    while True:
+                        chunk = xml_fp.read(EXPORT_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        yield chunk
+                return
+            except OSError:
+                _logger.warning("Arquivo do anexo %s não encontrado no filestore", attachment_id)
+                return
+        self.env.cr.execute("SELECT db_datas FROM ir_attachment WHERE id = %s", (attachment_id,))
+        row = self.env.cr.fetchone()
+        if row and row[0]:
+            yield bytes(row[0])
+
+    def _get_export_item_rows(self, root):
+        """Extrai os itens (det/prod) de uma NFe já analisada."""
+        rows = []
+        if root is None:
+            return rows
+        for det in root.iter(NFE_NS + 'det'):
+            prod = det.find(NFE_NS + 'prod')
+            if prod is None:
+                continue
+            rows.append([det.get('nItem', '')] + [
+                prod.findtext(NFE_NS + tag, default='')
+                for tag in ('cProd', 'xProd', 'NCM', 'uCom', 'qCom', 'vUnCom', 'vProd')
+            ])
+        return rows
+
+    def _iter_zip_stream(self):
+        """
+        Gera o ZIP com os XMLs selecionados e um CSV de cabeçalhos e itens.
+
+        Os anexos são lidos em blocos e cada bloco é repassado ao cliente assim
+        que comprimido; o CSV é montado em um arquivo temporário e anexado ao
+        final. A memória usada independe da quantidade de NFes exportadas.
+        """
+        self.ensure_one()
+        log_ids = self.log_ids.ids
+        buffer = _ZipStreamBuffer()
+
+        with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as csv_file, \
+                zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            csv_text = io.TextIOWrapper(csv_file, encoding='utf-8', newline='')
+            writer = csv.writer(csv_text, delimiter=';')
+            writer.writerow(EXPORT_CSV_HEADERS)
+
+            for start in range(0, len(log_ids), EXPORT_PAGE_SIZE):
+                page = tuple(log_ids[start:start + EXPORT_PAGE_SIZE])
+                self.env.cr.execute("""
+                    SELECT log.id, log.nfe_chave, log.nfe_numero, log.nfe_serie,
+                           log.emitente_cnpj, log.emitente_nome, log.data_emissao,
+                           log.valor_total, att.id, att.store_fname
+                    FROM nfe_imported_log log
+                    LEFT JOIN ir_attachment att
+                           ON att.res_model = 'nfe.imported.log'
+                          AND att.res_field = 'xml_file'
+                          AND att.res_id = log.id
+                    WHERE log.id IN %s
+                    ORDER BY log.id
+                """, (page,))
+                for (log_id, chave, numero, serie, cnpj, nome, data_emissao,
+                     valor_total, attachment_id, store_fname) in self.env.cr.fetchall():
+                    header = [chave, numero, serie, cnpj or '', nome or '',
+                              data_emissao or '', valor_total or 0.0]
+                    root = None
+                    if attachment_id:
+                        parser = etree.XMLPullParser(events=('end',), resolve_entities=False, no_network=True)
+                        with archive.open('%s.xml' % (chave or log_id), 'w') as entry:
+                            for chunk in self._iter_attachment_chunks(store_fname, attachment_id):
+                                entry.write(chunk)
+                                if parser is not None:
+                                    try:
+                                        parser.feed(chunk)
+                                    except etree.XMLSyntaxError:
+                                        _logger.warning("XML da NFe %s inválido; itens não exportados", chave)
+                                        parser = None
+                                data = buffer.drain()
+                                if data:
+                                    yield data
+                        if parser is not None:
+                            try:
+                                parser.close()
+                                for _event, element in parser.read_events():
+                                    root = element
+                            except etree.XMLSyntaxError:
+                                _logger.warning("XML da NFe %s inválido; itens não exportados", chave)
+
+                    item_rows = self._get_export_item_rows(root)
+                    if item_rows:
+                        writer.writerows(header + item for item in item_rows)
+                    else:
+                        writer.writerow(header)
+
+                    data = buffer.drain()
+                    if data:
+                        yield data
+
+                # Evita que o cache do ambiente cresça ao longo da exportação
+                self.env.invalidate_all()
+
+            csv_text.flush()
+            csv_file.seek(0)
+            with archive.open('nfes_itens.csv', 'w', force_zip64=True) as entry:
+                while True:
+                    chunk = csv_file.read(EXPORT_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    entry.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            csv_text.detach()
+
+        data = buffer.drain()
+        if data:
+            yield data
@@ -2,17 +2,40 @@
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
 import base64
-import xml.etree.ElementTree as ET
 import csv
 import io
 import logging
+import zipfile
 from datetime import datetime
-from odoo import api, fields, models
+from lxml import etree
+from psycopg2 import OperationalError
+from odoo import api, fields, models, tools
 from odoo.exceptions import UserError
+from odoo.tools import str2bool
 from odoo.tools.translate import _
 
+from .nfe_event import EVENT_CANCELAMENTO, EVENT_ROOT_TAGS
+from .nfe_import_context import NFeImportContext
+from .nfe_schema import (
+    DEFAULT_SCHEMA_DIR, NFE_NAMESPACE, NFeSchemaError, get_root_tag, parse_nfe_xml, validate_nfe_root,
+)
+from .nfe_stock_lock import CONCURRENCY_ERRORS_TO_RETRY
+from .res_partner import normalize_cnpj
+
 _logger = logging.getLogger(__name__)
 
+NFE_ROOT_TAGS = ('nfeProc', 'NFe')
+ZIP_MIMETYPES = ('application/zip', 'application/x-zip-compressed')
+
+BASE_IMPORT_NFE_HEADERS = (
+    'name',
+    'default_code',
+    'list_price',
+    'standard_price',
+    'qty_available',
+    'uom_id/name',
+)
+
 
 class NFeImport(models.Model):
     _name = "nfe.import"
@@ -48,6 +71,7 @@ class NFeImportedLog(models.Model):
     nfe_chave = fields.Char('Chave de Acesso', required=True, index=True)
     emitente_cnpj = fields.Char('CNPJ do Emitente')
     emitente_nome = fields.Char('Nome do Emitente')
+    partner_id = fields.Many2one('res.partner', 'Fornecedor', index=True, ondelete='set null')
     data_emissao = fields.Date('Data de Emissão')
     data_importacao = fields.Datetime('Data de Importação', default=fields.Datetime.now)
     usuario_importacao = fields.Many2one('res.users', 'Usuário', default=lambda self: self.env.user)
@@ -75,6 +99,18 @@ class NFeImportedLog(models.Model):
     ], string='Tipo', required=True, default='entrada')
     company_id = fields.Many2one('res.company', string='Empresa', required=True, default=lambda self: self.env.company)
 
+    # Situação fiscal e estoque lançado, usados para estornar cancelamentos
+    situacao = fields.Selection([
+        ('autorizada', 'Autorizada'),
+        ('cancelada', 'Cancelada'),
+    ], string='Situação', default='autorizada', required=True, index=True)
+    data_cancelamento = fields.Datetime('Data de Cancelamento', readonly=True)
+    event_ids = fields.One2many('nfe.imported.event', 'log_id', string='Eventos')
+    stock_location_id = fields.Many2one('stock.location', 'Localização de Estoque', readonly=True)
+    stock_quantities = fields.Json('Quantidades Lançadas', readonly=True,
+                                   help="Quantidade lançada no estoque por produto, no formato {product_id: quantidade}")
+    line_ids = fields.One2many('nfe.imported.line', 'log_id', string='Itens')
+
     _sql_constraints = [
         ('chave_unica', 'unique(nfe_chave)', 'Esta NFe já foi importada anteriormente!'),
     ]
@@ -93,6 +129,68 @@ class NFeImportedLog(models.Model):
             'target': 'self',
         }
 
+    def _reverse_stock(self):
+        """
+        Estorna do estoque as quantidades lançadas por estas NFes. As
+        quantidades são somadas por produto e localização e aplicadas com
+        um único UPDATE.
+
+        Retorna as NFes estornadas: as importadas antes do registro das
+        quantidades lançadas não têm o que estornar e ficam de fora.
+        """
+        totals = {}
+        reversed_logs = self.browse()
+        for log in self:
+            if not log.stock_location_id or not log.stock_quantities:
+                continue
+            reversed_logs |= log
+            for product_id, qty in log.stock_quantities.items():
+                key = (int(product_id), log.stock_location_id.id)
+                totals[key] = totals.get(key, 0.0) + qty
+        if not totals:
+            return reversed_logs
+
+        self.env['nfe.stock.lock']._acquire(totals)
+
+        product_ids, location_ids, quantities = [], [], []
+        for (product_id, location_id), qty in sorted(totals.items()):
+            product_ids.append(product_id)
+            location_ids.append(location_id)
+            quantities.append(qty)
+
+        self.env.cr.execute("""
+            UPDATE stock_quant q
+            SET quantity = q.quantity - v.qty,
+                write_date = NOW()
+            FROM (
+                SELECT DISTINCT ON (t.product_id, t.location_id) sq.id, t.qty
+                FROM unnest(%s::int[], %s::int[], %s::float8[]) AS t(product_id, location_id, qty)
+                JOIN stock_quant sq ON sq.product_id = t.product_id AND sq.location_id = t.location_id
+                ORDER BY t.product_id, t.location_id, sq.id
+            ) v
+            WHERE q.id = v.id
+        """, (product_ids, location_ids, quantities))
+        updated = self.env.cr.rowcount
+        if updated < len(totals):
+            _logger.warning("Estorno de NFe: %s produto(s) sem saldo na localização", len(totals) - updated)
+        self.env['stock.quant'].invalidate_model(['quantity'])
+        return reversed_logs
+
+    def action_export_xml_zip(self):
+        """
+        Ação para exportar os XMLs selecionados em um ZIP, junto com um CSV
+        de cabeçalhos e itens. O arquivo é gerado em streaming pelo controller.
+        """
+        if not self:
+            raise UserError(_("Selecione pelo menos uma NFe para exportar."))
+
+        export = self.env['nfe.xml.export'].create({'log_ids': [(6, 0, self.ids)]})
+        return {
+            'type': 'ir.actions.act_url',
+            'url': f'/nfe_xml_import/export/{export.id}',
+            'target': 'self',
+        }
+
 
 class NFeXmlImport(models.TransientModel):
     _name = "nfe.xml.import"
@@ -122,44 +220,82 @@ class NFeXmlImport(models.TransientModel):
         nfe_serie = ide.find('nfe:serie', ns).text if ide is not None and ide.find('nfe:serie', ns) is not None else ''
         data_emissao = ide.find('nfe:dhEmi', ns).text if ide is not None and ide.find('nfe:dhEmi', ns) is not None else ''
 
-        emit = nfe_info.find('nfe:emit', ns)
-        emitente_cnpj = emit.find('nfe:CNPJ', ns).text if emit is not None and emit.find('nfe:CNPJ', ns) is not None else ''
-        emitente_nome = emit.find('nfe:xNome', ns).text if emit is not None and emit.find('nfe:xNome', ns) is not None else ''
-
-        # Extração dos dados de endereço
-        ender_emit = emit.find('nfe:enderEmit', ns)
-        emitente_logradouro = ender_emit.find('nfe:xLgr', ns).text if ender_emit is not None and ender_emit.find('nfe:xLgr', ns) is not None else ''
-        emitente_numero_end = ender_emit.find('nfe:nro', ns).text if ender_emit is not None and ender_emit.find('nfe:nro', ns) is not None else ''
-        emitente_bairro = ender_emit.find('nfe:xBairro', ns).text if ender_emit is not None and ender_emit.find('nfe:xBairro', ns) is not None else ''
-        emitente_municipio = ender_emit.find('nfe:xMun', ns).text if ender_emit is not None and ender_emit.find('nfe:xMun', ns) is not None else ''
-        emitente_uf = ender_emit.find('nfe:UF', ns).text if ender_emit is not None and ender_emit.find('nfe:UF', ns) is not None else ''
-        emitente_cep = ender_emit.find('nfe:CEP', ns).text if ender_emit is not None and ender_emit.find('nfe:CEP', ns) is not None else ''
-
         total = nfe_info.find('nfe:total/nfe:ICMSTot/nfe:vNF', ns)
         valor_total = self._safe_float(total.text if total is not None else 0.0)
 
+        return dict(
+            self._extract_emitente_info(nfe_info.find('nfe:emit', ns), ns),
+            chave_acesso=chave_acesso,
+            numero=nfe_numero,
+            serie=nfe_serie,
+            data_emissao=data_emissao,
+            valor_total=valor_total,
+        )
+
+    def _extract_emitente_info(self, emit, ns):
+        """Dados do emitente (emit/enderEmit) usados no log e no cadastro do fornecedor."""
+        ender_emit = emit.find('nfe:enderEmit', ns) if emit is not None else None
+
+        def text(element, tag):
+            return (element.findtext(tag, default='', namespaces=ns) or '') if element is not None else ''
+
         return {
-            'chave_acesso': chave_acesso,
-            'numero': nfe_numero,
-            'serie': nfe_serie,
-            'data_emissao': data_emissao,
-            'emitente_cnpj': emitente_cnpj,
-            'emitente_nome': emitente_nome,
-            'valor_total': valor_total,
-            'emitente_logradouro': emitente_logradouro,
-            'emitente_numero_end': emitente_numero_end,
-            'emitente_bairro': emitente_bairro,
-            'emitente_municipio': emitente_municipio,
-            'emitente_uf': emitente_uf,
-            'emitente_cep': emitente_cep,
+            'emitente_cnpj': text(emit, 'nfe:CNPJ'),
+            'emitente_nome': text(emit, 'nfe:xNome'),
+            'emitente_logradouro': text(ender_emit, 'nfe:xLgr'),
+            'emitente_numero_end': text(ender_emit, 'nfe:nro'),
+            'emitente_bairro': text(ender_emit, 'nfe:xBairro'),
+            'emitente_municipio': text(ender_emit, 'nfe:xMun'),
+            'emitente_uf': text(ender_emit, 'nfe:UF'),
+            'emitente_cep': text(ender_emit, 'nfe:CEP'),
         }
 
+    def _scan_nfe_emitentes(self, xml_contents):
+        """
+        Lê apenas o bloco emit de cada XML de um lote, sem analisar os itens.
+        XMLs sem emitente (eventos) ou malformados são ignorados; o erro
+        aparece na importação do próprio arquivo.
+        """
+        ns = {'nfe': NFE_NAMESPACE}
+        infos = []
+        for xml_content in xml_contents:
+            try:
+                for _event, emit in etree.iterparse(io.BytesIO(xml_content), events=('end',),
+                                                    tag='{%s}emit' % NFE_NAMESPACE,
+                                                    resolve_entities=False, no_network=True):
+                    infos.append(self._extract_emitente_info(emit, ns))
+                    break
+            except etree.XMLSyntaxError:
+                continue
+        return infos
+
     def _check_nfe_already_imported(self, nfe_info):
         if not nfe_info.get('chave_acesso'):
             return False
         return self.env['nfe.imported.log'].search([('nfe_chave', '=', nfe_info['chave_acesso'])], limit=1).exists()
 
-    def _register_nfe_import(self, nfe_info):
+    def _resolve_nfe_partners(self, nfe_infos):
+        """
+        Resolve (ou cria) os fornecedores de um lote de NFes e grava o id do
+        parceiro em cada nfe_info, na chave 'partner_id'.
+        """
+        partner_map = self.env['res.partner']._nfe_resolve_suppliers(nfe_infos)
+        for nfe_info in nfe_infos:
+            nfe_info['partner_id'] = partner_map.get(normalize_cnpj(nfe_info.get('emitente_cnpj')), False)
+        return partner_map
+
+    def _register_nfe_import(self, nfe_info, partners=None):
+        """
+        Registra a NFe no log. Em lotes, partners traz os fornecedores já
+        resolvidos para todo o lote ({cnpj normalizado: id do parceiro}).
+        """
+        if 'partner_id' not in nfe_info:
+            cnpj = normalize_cnpj(nfe_info.get('emitente_cnpj'))
+            if partners is not None and cnpj in partners:
+                nfe_info['partner_id'] = partners[cnpj]
+            else:
+                self._resolve_nfe_partners([nfe_info])
+
         data_emissao = fields.Date.today()
         if nfe_info.get('data_emissao'):
             try:
@@ -168,12 +304,13 @@ class NFeXmlImport(models.TransientModel):
             except Exception:
                 pass
 
-        self.env['nfe.imported.log'].create({
+        return self.env['nfe.imported.log'].create({
             'nfe_numero': nfe_info.get('numero', ''),
             'nfe_serie': nfe_info.get('serie', ''),
             'nfe_chave': nfe_info.get('chave_acesso', ''),
             'emitente_cnpj': nfe_info.get('emitente_cnpj', ''),
             'emitente_nome': nfe_info.get('emitente_nome', ''),
+            'partner_id': nfe_info.get('partner_id') or False,
             'data_emissao': data_emissao,
             'valor_total': nfe_info.get('valor_total', 0.0),
             'xml_filename': self.xml_filename or '',
@@ -194,18 +331,41 @@ class NFeXmlImport(models.TransientModel):
         except (TypeError, ValueError):
             return 0.0
 
-    def _parse_nfe_xml(self, xml_content):
+    def _get_xsd_schema_dir(self):
+        """
+        Diretório dos schemas XSD, ou False se a validação estiver desativada.
+        Configurado pelos parâmetros de sistema nfe_xml_import.xsd_validation
+        e nfe_xml_import.xsd_path.
+        """
+        ICP = self.env['ir.config_parameter'].sudo()
+        if not str2bool(ICP.get_param('nfe_xml_import.xsd_validation', 'False')):
+            return False
+        return ICP.get_param('nfe_xml_import.xsd_path') or DEFAULT_SCHEMA_DIR
+
+    def _validate_nfe_schema(self, root):
+        # Lotes que já validaram os arquivos em paralelo não repetem a validação
+        if self.env.context.get('nfe_xsd_prevalidated'):
+            return
+        schema_dir = self._get_xsd_schema_dir()
+        if not schema_dir:
+            return
+        try:
+            validate_nfe_root(root, schema_dir)
+        except NFeSchemaError as e:
+            raise UserError(_("XML da NFe não é válido segundo o schema XSD:\n%s") % '\n'.join(e.errors))
+
+    def _parse_nfe_xml(self, xml_content, partners=None):
         """
         Analisa o conteúdo XML da NFe e extrai os dados dos produtos
         Retorna uma tupla: (produtos_data, nfe_info)
         """
         try:
-            if isinstance(xml_content, bytes):
-                xml_content = xml_content.decode('utf-8')
-
-            root = ET.fromstring(xml_content)
+            root = parse_nfe_xml(xml_content)
             ns = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
 
+            # Valida contra o XSD antes de qualquer acesso ao ORM
+            self._validate_nfe_schema(root)
+
             # Extrai informações da NFe
             nfe_info = self._extract_nfe_info(root, ns)
 
@@ -217,7 +377,7 @@ class NFeXmlImport(models.TransientModel):
                 ) % (nfe_info.get('numero'), nfe_info.get('serie'), nfe_info.get('emitente_nome')))
 
             # Registra a NFe no log
-            self._register_nfe_import(nfe_info)
+            nfe_info['log_id'] = self._register_nfe_import(nfe_info, partners).id
 
             produtos_data = []
             nfe_info_element = root.find('.//nfe:infNFe', ns)
@@ -241,6 +401,7 @@ class NFeXmlImport(models.TransientModel):
                     continue
 
                 produto_data = {
+                    'item': int(det.get('nItem') or 0),
                     'codigo_produto': codigo_produto,
                     'nome_produto': nome_produto or '',
                     'ncm': prod.find('nfe:NCM', ns).text if prod.find('nfe:NCM', ns) is not None else '',
@@ -248,7 +409,10 @@ class NFeXmlImport(models.TransientModel):
                     'valor_unitario': self._safe_float(prod.find('nfe:vUnCom', ns).text if prod.find('nfe:vUnCom', ns) is not None else 0.0),
                     'valor_total': self._safe_float(prod.find('nfe:vProd', ns).text if prod.find('nfe:vProd', ns) is not None else 0.0),
                     'unidade': prod.find('nfe:uCom', ns).text if prod.find('nfe:uCom', ns) is not None else '',
+                    'unidade_tributavel': prod.findtext('nfe:uTrib', default='', namespaces=ns),
+                    'quantidade_tributavel': self._safe_float(prod.findtext('nfe:qTrib', default='', namespaces=ns) or 0.0),
                     'emitente': nfe_info.get('emitente_nome', ''),
+                    'emitente_cnpj': nfe_info.get('emitente_cnpj', ''),
                     'data_emissao': data_emissao,
                     'chave_acesso': nfe_info.get('chave_acesso'),
                 }
@@ -256,7 +420,7 @@ class NFeXmlImport(models.TransientModel):
 
             return produtos_data, nfe_info
 
-        except ET.ParseError as e:
+        except etree.XMLSyntaxError as e:
             raise UserError(_("Erro ao analisar XML: %s") % str(e))
         except Exception as e:
             _logger.error("Erro ao processar XML da NFe: %s", str(e))
@@ -303,19 +467,94 @@ class NFeXmlImport(models.TransientModel):
 
         return headers, csv_data
 
-    def _create_or_update_products(self, produtos_data):
+    @api.model
+    @tools.ormcache('company_id')
+    def _get_import_defaults(self, company_id):
+        """
+        Resolve os padrões estáticos da importação para a empresa:
+        (categoria, localização, campo do tipo de produto, tipo, unidade).
+        Fica em cache no processo; ver NFeImportContext.
+        """
+        category = self.env.ref('product.product_category_all', raise_if_not_found=False)
+        if not category:
+            category = self.env['product.category'].search([], limit=1)
+            if not category:
+                raise UserError(_("Nenhuma categoria de produto foi encontrada. Por favor, crie uma categoria de produto para continuar."))
+
+        warehouse = self.env['stock.warehouse'].search([('company_id', '=', company_id)], limit=1)
+        location = warehouse.lot_stock_id or self.env.ref('stock.stock_location_stock', raise_if_not_found=False)
+        if not location:
+            raise UserError(_("Localização de estoque padrão não encontrada"))
+
+        type_field, type_value = self.env['nfe.import']._get_valid_product_type()
+        uom = self.env.ref('uom.product_uom_unit', raise_if_not_found=False)
+        return category.id, location.id, type_field, type_value, uom.id if uom else False
+
+    def _get_import_context(self, company=None):
+        """Monta o NFeImportContext da empresa (a atual, por padrão)."""
+        return NFeImportContext(self.env, company or self.env.company)
+
+    def _resolve_nfe_units(self, produtos_data):
+        """
+        Resolve a unidade de medida de cada item pela tabela de conversões do
+        fornecedor (ou global). A unidade tributável (uTrib/qTrib) tem
+        prioridade quando informada e mapeada; em seguida, a comercial
+        (uCom/qCom).
+
+        Grava em cada item 'uom_id' (ou False) e 'quantidade_uom', a
+        quantidade já multiplicada pelo fator de conversão. Sem conversão
+        cadastrada, vale a quantidade comercial, como antes da tabela.
+        """
+        Mapping = self.env['nfe.uom.mapping']
+        for produto in produtos_data:
+            candidates = []
+            if produto.get('unidade_tributavel') and produto.get('quantidade_tributavel'):
+                candidates.append((produto['unidade_tributavel'], produto['quantidade_tributavel']))
+            candidates.append((produto.get('unidade'), produto.get('quantidade', 0.0)))
+
+            produto['uom_id'] = False
+            produto['quantidade_uom'] = produto.get('quantidade', 0.0)
+            for unidade, quantidade in candidates:
+                mapping = Mapping._find_mapping(unidade, produto.get('emitente_cnpj'))
+                if mapping:
+                    uom_id, factor = mapping
+                    produto['uom_id'] = uom_id
+                    produto['quantidade_uom'] = quantidade * factor
+                    break
+
+    def _convert_to_product_uom(self, produtos_data, product_mapping):
+        """
+        Converte, para todos os itens de uma vez, a quantidade resolvida em
+        _resolve_nfe_units para a unidade de medida de cada produto, gravando
+        o resultado em 'quantidade'. A quantidade original fica em
+        'quantidade_comercial'.
+        """
+        product_ids = {product_mapping.get(p['codigo_produto'] or p['nome_produto']) for p in produtos_data}
+        products = self.env['product.product'].browse([pid for pid in product_ids if pid])
+        product_uoms = {product.id: product.uom_id for product in products}
+        uoms = self.env['uom.uom'].browse({p['uom_id'] for p in produtos_data if p.get('uom_id')})
+        uoms_by_id = {uom.id: uom for uom in uoms}
+
+        for produto in produtos_data:
+            produto.setdefault('quantidade_comercial', produto.get('quantidade', 0.0))
+            quantidade = produto.get('quantidade_uom', produto.get('quantidade', 0.0))
+            product_uom = product_uoms.get(product_mapping.get(produto['codigo_produto'] or produto['nome_produto']))
+            from_uom = uoms_by_id.get(produto.get('uom_id'))
+            if from_uom and product_uom and from_uom != product_uom:
+                if from_uom.category_id == product_uom.category_id:
+                    quantidade = from_uom._compute_quantity(quantidade, product_uom, round=False)
+                else:
+                    _logger.warning("Unidade %s incompatível com a do produto %s; conversão ignorada",
+                                    from_uom.name, produto['nome_produto'])
+            produto['quantidade'] = quantidade
+
+    def _create_or_update_products(self, produtos_data, import_ctx=None):
         """
         Cria ou atualiza produtos no Odoo baseado nos dados da NFe.
         """
         Product = self.env['product.product']
         product_mapping = {}
-
-        try:
-            default_categ = self.env.ref('product.product_category_all')
-        except ValueError:
-            default_categ = self.env['product.category'].search([], limit=1)
-            if not default_categ:
-                raise UserError(_("Nenhuma categoria de produto foi encontrada. Por favor, crie uma categoria de produto para continuar."))
+        import_ctx = import_ctx or self._get_import_context()
 
         for produto in produtos_data:
             codigo = produto.get('codigo_produto', '').strip()
@@ -336,15 +575,16 @@ class NFeXmlImport(models.TransientModel):
             if existing_product:
                 product_mapping[codigo or nome] = existing_product.id
             else:
-                product_vals = {
-                    'name': nome or f"Produto {codigo}",
-                    'default_code': codigo or None,
-                    'type': 'consu',
-                    'tracking': 'none',
-                    'categ_id': default_categ.id,
-                    'list_price': produto.get('valor_unitario', 0.0),
-                    'standard_price': produto.get('valor_unitario', 0.0),
-                }
+                product_vals = dict(
+                    import_ctx.product_vals(),
+                    name=nome or f"Produto {codigo}",
+                    default_code=codigo or None,
+                    tracking='none',
+                    list_price=produto.get('valor_unitario', 0.0),
+                    standard_price=produto.get('valor_unitario', 0.0),
+                )
+                if produto.get('uom_id'):
+                    product_vals.update({'uom_id': produto['uom_id'], 'uom_po_id': produto['uom_id']})
 
                 try:
                     new_product = Product.create(product_vals)
@@ -356,9 +596,13 @@ class NFeXmlImport(models.TransientModel):
 
         return product_mapping
 
-    def process_xml_import(self):
+    def process_xml_import(self, import_ctx=None, partners=None):
         """
         Processa a importação do XML da NFe, cria/atualiza produtos e estoque.
+
+        Em lotes, o chamador pode informar um NFeImportContext já montado,
+        evitando resolver os padrões estáticos a cada arquivo, e os
+        fornecedores do lote inteiro (ver _scan_nfe_emitentes).
         """
         self.ensure_one()
 
@@ -366,53 +610,57 @@ class NFeXmlImport(models.TransientModel):
             raise UserError(_("Por favor, selecione um arquivo XML"))
 
         xml_content = base64.b64decode(self.xml_file)
-        produtos_data, nfe_info = self._parse_nfe_xml(xml_content)
+        if get_root_tag(xml_content) in EVENT_ROOT_TAGS:
+            return self._process_event_xml(xml_content)
+
+        produtos_data, nfe_info = self._parse_nfe_xml(xml_content, partners)
 
         if not produtos_data:
             raise UserError(_("Nenhum produto encontrado no XML da NFe"))
 
-        product_mapping = self._create_or_update_products(produtos_data)
+        cancelled = self._apply_pending_events(nfe_info)
+        if cancelled:
+            return cancelled
 
-        location = self.env.ref('stock.stock_location_stock', raise_if_not_found=False)
-        if not location:
-            raise UserError(_("Localização de estoque padrão não encontrada"))
+        import_ctx = import_ctx or self._get_import_context()
+        self._resolve_nfe_units(produtos_data)
+        product_mapping = self._create_or_update_products(produtos_data, import_ctx)
+        self._convert_to_product_uom(produtos_data, product_mapping)
+
+        location = import_ctx.location
 
         created_records = []
         updated_records = []
         messages = []
-
+        quantities = {}
         for p in produtos_data:
             product_id = product_mapping.get(p['codigo_produto'] or p['nome_produto'])
             if not product_id:
                 messages.append({'type': 'warning', 'message': _("Produto não encontrado: %s") % p['nome_produto']})
                 continue
+            quantities[product_id] = quantities.get(product_id, 0.0) + p['quantidade']
 
-            self.env.cr.execute("""
-                SELECT id, quantity FROM stock_quant
-                WHERE product_id = %s AND location_id = %s
-                LIMIT 1
-            """, (product_id, location.id))
-            result = self.env.cr.fetchone()
-
-            if result:
-                quant_id, current_qty = result
-                self.env.cr.execute("""
-                    UPDATE stock_quant
-                    SET quantity = quantity + %s,
-                        write_date = NOW()
-                    WHERE id = %s
-                """, (p['quantidade'], quant_id))
+        quants = self.env['stock.quant']._nfe_add_quantities(location, quantities)
+
+        for p in produtos_data:
+            product_id = product_mapping.get(p['codigo_produto'] or p['nome_produto'])
+            if product_id not in quants:
+                continue
+            quant_id, created = quants[product_id]
+            if created:
+                created_records.append(quant_id)
+                messages.append({'type': 'success', 'message': _("Novo estoque criado para %s: %s") % (p['nome_produto'], p['quantidade'])})
+            else:
                 updated_records.append(quant_id)
                 messages.append({'type': 'success', 'message': _("Estoque atualizado para %s (+%s)") % (p['nome_produto'], p['quantidade'])})
-            else:
-                self.env.cr.execute("""
-                    INSERT INTO stock_quant (product_id, location_id, quantity, reserved_quantity, in_date, create_date, write_date)
-                    VALUES (%s, %s, %s, %s, NOW(), NOW(), NOW())
-                    RETURNING id
-                """, (product_id, location.id, p['quantidade'], 0.0))
-                new_id = self.env.cr.fetchone()[0]
-                created_records.append(new_id)
-                messages.append({'type': 'success', 'message': _("Novo estoque criado para %s: %s") % (p['nome_produto'], p['quantidade'])})
+
+        self.env['nfe.imported.line']._create_from_nfe(nfe_info, produtos_data, product_mapping)
+
+        # Guarda o que foi lançado para permitir o estorno em caso de cancelamento
+        self.env['nfe.imported.log'].browse(nfe_info['log_id']).write({
+            'stock_location_id': location.id,
+            'stock_quantities': {str(product_id): qty for product_id, qty in quantities.items()},
+        })
 
         nfe_chave = nfe_info.get('chave_acesso', '').replace('NFe', '').strip()
         _logger.info("NFe importada com sucesso: %s", nfe_chave)
@@ -423,6 +671,56 @@ class NFeXmlImport(models.TransientModel):
             'name': _("Importação NFe - %s produtos processados") % len(produtos_data),
             'created_count': len(created_records),
             'updated_count': len(updated_records),
+            'log_id': nfe_info['log_id'],
+        }
+
+    def _apply_pending_events(self, nfe_info):
+        """
+        Vincula à NFe os eventos importados antes dela. Se um deles for o
+        cancelamento, a NFe é registrada como cancelada e nada é lançado no
+        estoque; nesse caso retorna o resultado da importação.
+        """
+        if not nfe_info.get('chave_acesso'):
+            return False
+        events = self.env['nfe.imported.event'].search([
+            ('nfe_chave', '=', nfe_info['chave_acesso']),
+            ('log_id', '=', False),
+        ])
+        if not events:
+            return False
+        log = self.env['nfe.imported.log'].browse(nfe_info['log_id'])
+        events.write({'log_id': log.id})
+        cancel_event = events.filtered(lambda e: e.tipo_evento == EVENT_CANCELAMENTO)[:1]
+        if not cancel_event:
+            return False
+
+        log.write({
+            'situacao': 'cancelada',
+            'data_cancelamento': cancel_event.data_evento or fields.Datetime.now(),
+        })
+        _logger.info("NFe %s já cancelada por evento importado; estoque não lançado", nfe_info['chave_acesso'])
+        return {
+            'ids': [],
+            'messages': [{'type': 'warning', 'message': _(
+                "NFe %s cancelada por evento importado anteriormente; estoque não lançado") % log.nfe_numero}],
+            'name': _("Importação NFe - NFe cancelada"),
+            'created_count': 0,
+            'updated_count': 0,
+            'log_id': log.id,
+        }
+
+    def _process_event_xml(self, xml_content):
+        """
+        Processa um XML de evento (cancelamento, carta de correção) no lugar
+        de uma NFe.
+        """
+        result = self.env['nfe.imported.event']._process_event_files([(self.xml_filename, xml_content)])
+        return {
+            'ids': result['events'].ids,
+            'messages': result['messages'],
+            'name': _("Importação de Eventos NFe - %s eventos processados") % len(result['events']),
+            'created_count': len(result['events']),
+            'updated_count': 0,
         }
 
     # ... (métodos _import_to_inventory, _import_to_stock_quant, etc. sem alterações) ...
@@ -571,76 +869,153 @@ class StockQuantInherit(models.Model):
     nfe_reference = fields.Char('Referência NFe', help="Referência da Nota Fiscal de origem")
     import_date = fields.Datetime('Data de Importação', default=fields.Datetime.now)
 
+    @api.model
+    def _nfe_add_quantities(self, location, quantities):
+        """
+        Soma as quantidades {product_id: quantidade} ao estoque da localização.
+
+        Os pares (produto, localização) são travados em ordem determinística
+        antes de ler os quants, de modo que importações paralelas não criem
+        quants duplicados nem percam incrementos. O quant de menor id é o
+        atualizado; produtos sem quant na localização ganham um novo.
+
+        Retorna {product_id: (quant_id, criado)}.
+        """
+        if not quantities:
+            return {}
+        product_ids = sorted(quantities)
+        self.env['nfe.stock.lock']._acquire((product_id, location.id) for product_id in product_ids)
+
+        self.env.cr.execute("""
+            UPDATE stock_quant q
+            SET quantity = q.quantity + v.qty,
+                write_date = NOW()
+            FROM (
+                SELECT DISTINCT ON (sq.product_id) sq.id, t.qty
+                FROM unnest(%s::int[], %s::float8[]) AS t(product_id, qty)
+                JOIN stock_quant sq ON sq.product_id = t.product_id AND sq.location_id = %s
+                ORDER BY sq.product_id, sq.id
+            ) v
+            WHERE q.id = v.id
+            RETURNING q.product_id, q.id
+        """, (product_ids, [quantities[pid] for pid in product_ids], location.id))
+        result = {product_id: (quant_id, False) for product_id, quant_id in self.env.cr.fetchall()}
+
+        missing = [pid for pid in product_ids if pid not in result]
+        if missing:
+            self.env.cr.execute("""
+                INSERT INTO stock_quant (product_id, location_id, company_id, quantity, reserved_quantity,
+                                         in_date, create_date, write_date)
+                SELECT t.product_id, loc.id, loc.company_id, t.qty, 0.0, NOW(), NOW(), NOW()
+                FROM unnest(%s::int[], %s::float8[]) AS t(product_id, qty)
+                JOIN stock_location loc ON loc.id = %s
+                RETURNING product_id, id
+            """, (missing, [quantities[pid] for pid in missing], location.id))
+            result.update((product_id, (quant_id, True)) for product_id, quant_id in self.env.cr.fetchall())
+
+        self.invalidate_model(['quantity'])
+        return result
+
 class BaseImportExtended(models.TransientModel):
     _inherit = 'base_import.import'
 
     @api.model
     def _read_file(self, options):
         """
-        Estende o método _read_file para suportar arquivos XML de NFe
+        Estende o método _read_file para suportar arquivos XML de NFe e
+        arquivos ZIP com vários XMLs de NFe
         """
-        if self.file_type == 'application/xml' or (self.file_name and self.file_name.lower().endswith('.xml')):
-            try:
-                xml_content = self.file or b''
-                if b'nfeProc' in xml_content or b'NFe' in xml_content:
-                    return self._read_xml_nfe(options)
-            except:
-                pass
+        file_name = (self.file_name or '').lower()
+        if self.file_type in ZIP_MIMETYPES or file_name.endswith('.zip'):
+            if self.file and zipfile.is_zipfile(io.BytesIO(self.file)):
+                return self._read_zip_nfe(options)
+
+        if self.file_type == 'application/xml' or file_name.endswith('.xml'):
+            if get_root_tag(self.file or b'') in NFE_ROOT_TAGS:
+                return self._read_xml_nfe(options)
 
         return super()._read_file(options)
 
+    def _iter_nfe_rows(self, xml_stream):
+        """
+        Lê um XML de NFe em streaming e gera uma linha de importação por item.
+        Só o elemento raiz é verificado antes de decidir se o documento é uma
+        NFe; cada item é descartado da árvore logo após ser convertido.
+        """
+        ns = '{http://www.portalfiscal.inf.br/nfe}'
+        root_checked = False
+        for event, element in etree.iterparse(xml_stream, events=('start', 'end'),
+                                              resolve_entities=False, no_network=True):
+            if not root_checked:
+                root_checked = True
+                if etree.QName(element).localname not in NFE_ROOT_TAGS:
+                    raise UserError(_("O arquivo não é uma NFe (elemento raiz %s)") % etree.QName(element).localname)
+                continue
+            if event != 'end' or element.tag != ns + 'det':
+                continue
+
+            prod = element.find(ns + 'prod')
+            if prod is not None:
+                valor_unit = prod.findtext(ns + 'vUnCom') or '0'
+                yield [
+                    prod.findtext(ns + 'xProd') or '',
+                    prod.findtext(ns + 'cProd') or '',
+                    valor_unit,
+                    valor_unit,
+                    prod.findtext(ns + 'qCom') or '0',
+                    prod.findtext(ns + 'uCom') or 'un',
+                ]
+            element.clear()
+
     def _read_xml_nfe(self, options):
         """
         Processa arquivo XML de NFe e converte para formato de importação
         """
         try:
-            xml_content = self.file or b''
-            root = ET.fromstring(xml_content)
-            ns = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
-
-            headers = [
-                'name',
-                'default_code',
-                'list_price',
-                'standard_price',
-                'qty_available',
-                'uom_id/name',
-            ]
-
-            rows = [headers]
-
-            nfe_info = root.find('.//nfe:infNFe', ns)
-            if nfe_info is not None:
-                detalhes = nfe_info.findall('nfe:det', ns)
-
-                for det in detalhes:
-                    prod = det.find('nfe:prod', ns)
-                    if prod is None:
-                        continue
-
-                    nome = prod.find('nfe:xProd', ns).text if prod.find('nfe:xProd', ns) is not None else ''
-                    codigo = prod.find('nfe:cProd', ns).text if prod.find('nfe:cProd', ns) is not None else ''
-                    valor_unit = prod.find('nfe:vUnCom', ns).text if prod.find('nfe:vUnCom', ns) is not None else '0'
-                    quantidade = prod.find('nfe:qCom', ns).text if prod.find('nfe:qCom', ns) is not None else '0'
-                    unidade = prod.find('nfe:uCom', ns).text if prod.find('nfe:uCom', ns) is not None else 'un'
-
-                    linha_dados = [
-                        nome,
-                        codigo,
-                        valor_unit,
-                        valor_unit,
-                        quantidade,
-                        unidade,
-                    ]
-
-                    rows.append(linha_dados)
-
+            rows = [list(BASE_IMPORT_NFE_HEADERS)]
+            rows.extend(self._iter_nfe_rows(io.BytesIO(self.file or b'')))
             return len(rows) - 1, rows
 
         except Exception as e:
             _logger.error("Erro ao processar XML NFe: %s", str(e))
             raise UserError(_("Erro ao processar arquivo XML: %s") % str(e))
 
+    def _iter_zip_nfe_rows(self, archive, failures):
+        """
+        Gera as linhas de todos os XMLs de um ZIP, abrindo uma entrada por
+        vez. Entradas com erro são anotadas em failures e ignoradas.
+        """
+        for info in archive.infolist():
+            if info.is_dir() or not info.filename.lower().endswith('.xml'):
+                continue
+            entry_rows = []
+            try:
+                with archive.open(info) as entry:
+                    entry_rows.extend(self._iter_nfe_rows(entry))
+            except (UserError, etree.XMLSyntaxError, zipfile.BadZipFile, OSError) as e:
+                failures.append((info.filename, str(e)))
+                continue
+            yield from entry_rows
+
+    def _read_zip_nfe(self, options):
+        """
+        Processa um ZIP com XMLs de NFe como uma única importação. Os
+        arquivos com erro são informados juntos, com o nome de cada entrada.
+        """
+        failures = []
+        with zipfile.ZipFile(io.BytesIO(self.file)) as archive:
+            rows = [list(BASE_IMPORT_NFE_HEADERS)]
+            # O base_import precisa de uma lista com o total de linhas
+            rows.extend(self._iter_zip_nfe_rows(archive, failures))
+
+        if failures:
+            _logger.warning("ZIP de NFe com %s arquivo(s) inválido(s): %s", len(failures), failures)
+            raise UserError(_("Os seguintes arquivos do ZIP não puderam ser lidos:\n%s") % '\n'.join(
+                "- %s: %s" % (name, message) for name, message in failures))
+        if len(rows) == 1:
+            raise UserError(_("Nenhum item de NFe encontrado no arquivo ZIP."))
+        return len(rows) - 1, rows
+
 class NFeImportWizard(models.TransientModel):
     """
     Wizard simplificado para importação de XMLs de NFe
@@ -648,7 +1023,9 @@ class NFeImportWizard(models.TransientModel):
     _name = 'nfe.import.wizard'
     _description = 'Assistente de Importação NFe'
 
-    xml_file = fields.Binary('Arquivo XML NFe', required=True)
+    xml_file = fields.Binary('Arquivo XML NFe', required=True,
+                             help="XML de uma NFe ou evento, ou um ZIP com vários XMLs. "
+                                  "ZIPs são importados em segundo plano, como um lote de importação.")
     xml_filename = fields.Char('Nome do Arquivo')
 
     import_type = fields.Selection([
@@ -673,6 +1050,10 @@ class NFeImportWizard(models.TransientModel):
         if not self.xml_file:
             raise UserError(_("Por favor, selecione um arquivo XML"))
 
+        content = base64.b64decode(self.xml_file)
+        if zipfile.is_zipfile(io.BytesIO(content)):
+            return self._action_import_zip(content)
+
         target_model = self.env['ir.model'].search([
             ('model', '=', 'stock.inventory' if self.import_type in ['inventory', 'both'] else 'product.product')
         ], limit=1)
@@ -714,6 +1095,28 @@ class NFeImportWizard(models.TransientModel):
 
         except UserError:
             raise
+        except OperationalError as e:
+            # Conflitos de concorrência são repetidos pelo próprio Odoo
+            if e.pgcode in CONCURRENCY_ERRORS_TO_RETRY:
+                raise
+            _logger.error("Erro na importação NFe: %s", str(e))
+            raise UserError(_("Erro durante a importação: %s") % str(e))
         except Exception as e:
             _logger.error("Erro na importação NFe: %s", str(e))
-            raise UserError(_("Erro durante a importação: %s") % str(e))
\ No newline at end of file
+            raise UserError(_("Erro durante a importação: %s") % str(e))
+
+    def _action_import_zip(self, content):
+        """
+        Cria um lote de importação com os XMLs do ZIP e agenda a execução.
+        Cada arquivo é confirmado no banco ao ser importado, e o lote é
+        retomado pelo cron se for interrompido.
+        """
+        run = self.env['nfe.import.run']._create_from_content(content, self.xml_filename)
+        self.env.ref('nfe_xml_import.ir_cron_nfe_import_run_resume')._trigger()
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': 'nfe.import.run',
+            'res_id': run.id,
+            'view_mode': 'form',
+            'target': 'current',
+        }
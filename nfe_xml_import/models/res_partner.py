@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import logging
+import re
+
+from odoo import api, fields, models
+from odoo.tools.lru import LRU
+
+_logger = logging.getLogger(__name__)
+
+# Cache por processo (worker) de CNPJ normalizado -> id do parceiro.
+# A chave inclui o nome do banco, pois um mesmo worker pode atender várias bases.
+_SUPPLIER_CACHE = LRU(8192)
+
+
+def _discard_cached_supplier(key):
+    try:
+        del _SUPPLIER_CACHE[key]
+    except KeyError:
+        pass
+
+
+def normalize_cnpj(value):
+    """Remove pontuação e prefixos do CNPJ/CPF, mantendo apenas os dígitos."""
+    return re.sub(r'\D', '', value or '')
+
+
+class ResPartner(models.Model):
+    _inherit = 'res.partner'
+
+    nfe_vat_digits = fields.Char(
+        'CNPJ/CPF (somente dígitos)',
+        compute='_compute_nfe_vat_digits', store=True, index=True,
+        help="CNPJ/CPF normalizado, usado para localizar o fornecedor na importação de NFe",
+    )
+
+    @api.depends('vat')
+    def _compute_nfe_vat_digits(self):
+        for partner in self:
+            partner.nfe_vat_digits = normalize_cnpj(partner.vat) or False
+
+    def write(self, vals):
+        if 'vat' in vals or 'active' in vals:
+            self._nfe_evict_supplier_cache()
+        return super().write(vals)
+
+    def unlink(self):
+        self._nfe_evict_supplier_cache()
+        return super().unlink()
+
+    def _nfe_evict_supplier_cache(self):
+        dbname = self.env.cr.dbname
+        for digits in self.mapped('nfe_vat_digits'):
+            if digits:
+                _discard_cached_supplier((dbname, digits))
+
+    @api.model
+    def _nfe_prepare_supplier_vals(self, nfe_info, states_by_code, country_id=False):
+        """Monta os valores de criação do fornecedor a partir de emit/enderEmit."""
+        logradouro = nfe_info.get('emitente_logradouro') or ''
+        numero = nfe_info.get('emitente_numero_end') or ''
+        uf = (nfe_info.get('emitente_uf') or '').upper()
+        vals = {
+            'name': nfe_info.get('emitente_nome') or nfe_info['emitente_cnpj'],
+            'vat': nfe_info['emitente_cnpj'],
+            'is_company': True,
+            'street': ', '.join(part for part in (logradouro, numero) if part) or False,
+            'street2': nfe_info.get('emitente_bairro') or False,
+            'city': nfe_info.get('emitente_municipio') or False,
+            'zip': nfe_info.get('emitente_cep') or False,
+            'state_id': states_by_code.get(uf, False),
+            'country_id': country_id,
+        }
+        if 'supplier_rank' in self._fields:
+            vals['supplier_rank'] = 1
+        return vals
+
+    @api.model
+    def _nfe_resolve_suppliers(self, nfe_infos):
+        """
+        Resolve os fornecedores de um lote de NFes pelo CNPJ do emitente.
+
+        Consulta primeiro o cache do processo. Se todos os CNPJs estiverem
+        nele, uma consulta pela chave primária confirma que os parceiros
+        ainda existem e estão ativos: o cache é local ao worker, e um
+        parceiro removido ou mesclado em outro worker continuaria nele.
+        Havendo CNPJs fora do cache (ou ids obsoletos), uma única consulta
+        busca todos os do lote, e os fornecedores inexistentes são criados
+        em um único ``create`` multi-registro. O número de consultas
+        independe da quantidade de fornecedores do lote.
+
+        Retorna um dicionário {cnpj normalizado: id do parceiro}.
+        """
+        dbname = self.env.cr.dbname
+        infos_by_cnpj = {}
+        for info in nfe_infos:
+            cnpj = normalize_cnpj(info.get('emitente_cnpj'))
+            if cnpj and cnpj not in infos_by_cnpj:
+                infos_by_cnpj[cnpj] = dict(info, emitente_cnpj=cnpj)
+        if not infos_by_cnpj:
+            return {}
+
+        result = {}
+        for cnpj in infos_by_cnpj:
+            partner_id = _SUPPLIER_CACHE.get((dbname, cnpj))
+            if partner_id:
+                result[cnpj] = partner_id
+        if len(result) == len(infos_by_cnpj):
+            cached_ids = set(result.values())
+            self.env.cr.execute("SELECT id FROM res_partner WHERE id IN %s AND active", (tuple(cached_ids),))
+            if len(self.env.cr.fetchall()) == len(cached_ids):
+                return result
+
+        # Alguém fora do cache ou obsoleto: a mesma consulta revalida o lote
+        # inteiro, descartando ids removidos ou arquivados por outro processo
+        self.env.cr.execute("""
+            SELECT DISTINCT ON (nfe_vat_digits) nfe_vat_digits, id
+            FROM res_partner
+            WHERE nfe_vat_digits IN %s AND active
+            ORDER BY nfe_vat_digits, is_company DESC, id
+        """, (tuple(infos_by_cnpj),))
+        result = dict(self.env.cr.fetchall())
+        for cnpj in infos_by_cnpj:
+            if cnpj in result:
+                _SUPPLIER_CACHE[(dbname, cnpj)] = result[cnpj]
+            else:
+                _discard_cached_supplier((dbname, cnpj))
+
+        to_create = [cnpj for cnpj in infos_by_cnpj if cnpj not in result]
+        if to_create:
+            ufs = {(infos_by_cnpj[cnpj].get('emitente_uf') or '').upper() for cnpj in to_create}
+            states = self.env['res.country.state'].search([
+                ('country_id.code', '=', 'BR'),
+                ('code', 'in', [uf for uf in ufs if uf]),
+            ])
+            states_by_code = {state.code: state.id for state in states}
+            country = self.env.ref('base.br', raise_if_not_found=False)
+            partners = self.create([
+                self._nfe_prepare_supplier_vals(infos_by_cnpj[cnpj], states_by_code, country.id if country else False)
+                for cnpj in to_create
+            ])
+            created = dict(zip(to_create, partners.ids))
+            result.update(created)
+            _logger.info("Fornecedores criados a partir de NFe: %s", len(created))
+
+            # Só publica no cache após o commit, para não guardar ids de uma
+            # transação que pode ser revertida.
+            def _cache_created_suppliers():
+                for cnpj, partner_id in created.items():
+                    _SUPPLIER_CACHE[(dbname, cnpj)] = partner_id
+            self.env.cr.postcommit.add(_cache_created_suppliers)
+
+        return result
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+
+from psycopg2 import OperationalError, errorcodes
+
+from odoo import SUPERUSER_ID, api
+from odoo.modules.registry import Registry
+from odoo.tests.common import BaseCase, get_db_name, tagged
+from odoo.tools import mute_logger
+
+from ..models.nfe_stock_lock import retry_on_concurrency_error
+
+
+@contextmanager
+def environment():
+    """Ambiente com cursor próprio, confirmado ao sair, fora da transação do teste."""
+    with Registry(get_db_name()).cursor() as cr:
+        yield api.Environment(cr, SUPERUSER_ID, {})
+
+
+@tagged('-at_install', 'post_install')
+class TestNFeStockLock(BaseCase):
+    """
+    Duas importações concorrentes do mesmo produto e localização, cada uma
+    com o seu cursor, como dois workers do Odoo.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with environment() as env:
+            type_field, type_value = env['nfe.import']._get_valid_product_type()
+            vals = {'name': 'Produto Teste Concorrência NFe'}
+            if type_field:
+                vals[type_field] = type_value
+            if 'is_storable' in env['product.product']._fields:
+                vals['is_storable'] = True
+            cls.product_id = env['product.product'].create(vals).id
+            cls.location_id = env.ref('stock.stock_location_stock').id
+
+    @classmethod
+    def tearDownClass(cls):
+        with environment() as env:
+            cls._clear_stock(env)
+            env['product.product'].browse(cls.product_id).unlink()
+        super().tearDownClass()
+
+    @classmethod
+    def _clear_stock(cls, env):
+        env.cr.execute("DELETE FROM stock_quant WHERE product_id = %s", (cls.product_id,))
+        env.cr.execute("DELETE FROM nfe_stock_lock WHERE product_id = %s", (cls.product_id,))
+
+    def setUp(self):
+        super().setUp()
+        with environment() as env:
+            self._clear_stock(env)
+
+    def _add(self, env, qty):
+        location = env['stock.location'].browse(self.location_id)
+        return env['stock.quant']._nfe_add_quantities(location, {self.product_id: qty})
+
+    def assertStock(self, quantity):
+        with environment() as env:
+            env.cr.execute("""
+                SELECT count(*), sum(quantity) FROM stock_quant
+                WHERE product_id = %s AND location_id = %s
+            """, (self.product_id, self.location_id))
+            count, total = env.cr.fetchone()
+        self.assertEqual(count, 1, "As importações concorrentes devem compartilhar um único quant")
+        self.assertAlmostEqual(total, quantity)
+
+    def test_concurrent_import_blocks(self):
+        """A segunda importação espera a primeira terminar."""
+        with environment() as env1, environment() as env2:
+            self._add(env1, 10.0)
+
+            # Sem o timeout, o segundo cursor ficaria esperando o commit do primeiro
+            env2.cr.execute("SET LOCAL lock_timeout = '500ms'")
+            with self.assertRaises(OperationalError) as catcher, mute_logger('odoo.sql_db'):
+                self._add(env2, 5.0)
+            self.assertEqual(catcher.exception.pgcode, errorcodes.LOCK_NOT_AVAILABLE)
+            env2.cr.rollback()
+
+            env1.cr.commit()
+            retry_on_concurrency_error(env2.cr, self._add, env2, 5.0)
+
+        self.assertStock(15.0)
+
+    def test_concurrent_import_stale_snapshot(self):
+        """Com um snapshot anterior ao commit da primeira, a segunda falha e é repetida."""
+        with environment() as env1, environment() as env2:
+            # Fixa o snapshot do segundo cursor antes da primeira importação
+            env2.cr.execute("SELECT count(*) FROM stock_quant WHERE product_id = %s", (self.product_id,))
+
+            self._add(env1, 10.0)
+            env1.cr.commit()
+
+            with self.assertRaises(OperationalError) as catcher, mute_logger('odoo.sql_db'):
+                self._add(env2, 5.0)
+            self.assertEqual(catcher.exception.pgcode, errorcodes.SERIALIZATION_FAILURE)
+            env2.cr.rollback()
+
+            retry_on_concurrency_error(env2.cr, self._add, env2, 5.0)
+
+        self.assertStock(15.0)